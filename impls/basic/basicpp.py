@@ -2,6 +2,9 @@
 
 from __future__ import print_function
 import argparse
+import hashlib
+import json
+import os
 import re
 import sys
 
@@ -24,6 +27,8 @@ def parse_args():
                         help='Skip miscellaneous fixup/shrink fixups')
     parser.add_argument('--skip-combine-lines', action='store_true', default=False,
                         help='Do not combine lines using the ":" separator')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory caching the preprocessed files')
 
     args = parser.parse_args()
     args.full_mode = "%s-%s" % (args.mode, args.sub_mode)
@@ -37,30 +42,6 @@ def parse_args():
 
     return args
 
-# pull in include files
-def resolve_includes(orig_lines, args):
-    included = {}
-    lines = orig_lines[:]
-    position = 0
-    while position < len(lines):
-        line = lines[position]
-        m = re.match(r"^(?:#([^ ]*) )? *REM \$INCLUDE: '([^'\n]*)' *$", line)
-        if m:
-            mode = m.group(1)
-            f = m.group(2)
-            if mode and mode != args.mode and mode != args.full_mode:
-                position += 1
-            elif f not in included:
-                ilines = [l.rstrip() for l in open(f).readlines()]
-                if args.keep_rems: lines.append("REM vvv BEGIN '%s' vvv" % f)
-                lines[position:position+1] = ilines
-                if args.keep_rems: lines.append("REM ^^^ END '%s' ^^^" % f)
-            else:
-                debug("Ignoring already included file: %s" % f)
-        else:
-            position += 1
-    return lines
-
 def resolve_mode(orig_lines, args):
     lines = []
     for line in orig_lines:
@@ -101,34 +82,204 @@ def remove_indent(orig_lines):
         lines.append(m.group(1))
     return lines
 
+# Miscellaneous fixups, applied in a single pass:
+# - remove GOTO after THEN
+# - remove spaces after keywords
+# - remove spaces around GOTO/GOSUB/THEN
+# - remove spaces around AND/OR except after ST
+MISC_FIXUPS_RE = re.compile(
+    r" *\bTHEN GOTO\b *| *THEN *| *GOTO *| *GOSUB *"
+    r"|\b(?:IF|DIM|GET|POKE|CLOSE|FOR|NEXT) |OPEN |\bPRINT *| TO "
+    r"|(?<!ST) *AND *|([^A-Z]) *OR *")
+
+def misc_fixup(m):
+    if m.group(1) is not None:
+        return m.group(1) + "OR"
+    text = m.group().replace(" ", "")
+    return "THEN" if text == "THENGOTO" else text
+
 def misc_fixups(orig_lines):
     text = "\n".join(orig_lines)
+    text = MISC_FIXUPS_RE.sub(misc_fixup, text)
+    return text.split("\n")
 
-    # Remove GOTO after THEN
-    text = re.sub(r"\bTHEN GOTO\b", "THEN", text)
-
-    # Remove spaces after keywords
-    text = re.sub(r"\bIF ", "IF", text)
-    text = re.sub(r"\bPRINT *", "PRINT", text)
-    text = re.sub(r"\bDIM ", "DIM", text)
-    text = re.sub(r"\OPEN ", "OPEN", text)
-    text = re.sub(r"\bGET ", "GET", text)
-    text = re.sub(r"\bPOKE ", "POKE", text)
-    text = re.sub(r"\bCLOSE ", "CLOSE", text)
-    text = re.sub(r"\bFOR ", "FOR", text)
-    text = re.sub(r" TO ", "TO", text)
-    text = re.sub(r"\bNEXT ", "NEXT", text)
-
-    # Remove spaces around GOTO/GOSUB/THEN
-    text = re.sub(r" *GOTO *", "GOTO", text)
-    text = re.sub(r" *GOSUB *", "GOSUB", text)
-    text = re.sub(r" *THEN *", r"THEN", text)
-
-    # Remove spaces around AND/OR except after ST
-    text = re.sub(r"(?<!ST) *AND *", r"AND", text)
-    text = re.sub(r"([^A-Z]) *OR *", r"\g<1>OR", text)
+# Each file is preprocessed on its own (resolving modes, dropping
+# blank lines and REMs, removing the indenting and applying the fixups)
+# into a fragment: a list of segments of finished lines and of names of
+# included files. Fragments are cached by the hash of their contents
+# and of the options (in memory, and on disk with --cache-dir), so that
+# a rebuild only processes the files that changed before linking them
+# back into a program for finalize.
+INCLUDE_RE = re.compile(r"^(?:#([^ ]*) )? *REM \$INCLUDE: '([^'\n]*)' *$")
+
+def to_bytes(text):
+    return text if isinstance(text, bytes) else text.encode("utf-8")
+
+with open(os.path.abspath(__file__)) as f:
+    BASICPP_HASH = hashlib.sha1(to_bytes(f.read())).hexdigest()
+
+def fixup_lines(lines, args, follows_line):
+    if args.skip_misc_fixups or not lines:
+        return lines
+    # the fixups of a line may depend on a line preceding it
+    if follows_line:
+        return misc_fixups([""] + lines)[1:]
+    return misc_fixups(lines)
+
+def preprocess_fragment(raw_lines, args):
+    segments = [[]]
+    for line in raw_lines:
+        m = INCLUDE_RE.match(line)
+        if not m:
+            segments[-1].append(line)
+            continue
+        mode = m.group(1)
+        # includes for other modes are dropped like other mode lines
+        if mode and mode != args.mode and mode != args.full_mode:
+            continue
+        segments.append(m.group(2))
+        segments.append([])
 
-    return text.split("\n")
+    fragment = []
+    for seg in segments:
+        if not isinstance(seg, list):
+            fragment.append({"include": seg})
+            continue
+        seg = resolve_mode(seg, args)
+        if not args.keep_blank_lines: seg = drop_blank_lines(seg)
+        if not args.keep_rems: seg = drop_rems(seg)
+        if not args.keep_indent: seg = remove_indent(seg)
+        if seg:
+            # the first line is fixed up on its own in case it starts
+            # the program
+            fragment.append({"lines": fixup_lines(seg, args, True),
+                             "first": fixup_lines(seg[:1], args, False)[0]})
+    return fragment
+
+class FragmentCache(object):
+    def __init__(self, args):
+        self.args = args
+        self.fragments = {}
+        self.options = repr([BASICPP_HASH, args.mode, args.full_mode,
+                             args.keep_rems, args.keep_blank_lines,
+                             args.keep_indent, args.skip_misc_fixups])
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, raw_lines):
+        h = hashlib.sha1(to_bytes(self.options))
+        h.update(to_bytes("\n".join(raw_lines)))
+        key = h.hexdigest()
+        if key in self.fragments:
+            return self.fragments[key]
+
+        path = None
+        if self.args.cache_dir:
+            path = os.path.join(self.args.cache_dir, key + ".json")
+            try:
+                with open(path) as f:
+                    self.fragments[key] = json.load(f)
+                self.hits += 1
+                return self.fragments[key]
+            except (IOError, OSError, ValueError):
+                pass
+
+        fragment = preprocess_fragment(raw_lines, self.args)
+        self.misses += 1
+        self.fragments[key] = fragment
+        if path:
+            # failing to write the cache only makes the next build slower
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            try:
+                if not os.path.isdir(self.args.cache_dir):
+                    os.makedirs(self.args.cache_dir)
+                with open(tmp, "w") as f:
+                    json.dump(fragment, f)
+                os.rename(tmp, path)
+            except (IOError, OSError):
+                pass
+        return fragment
+
+def read_lines(filename):
+    with open(filename) as f:
+        return [l.rstrip() for l in f.readlines()]
+
+# pull in include files
+def link(fragment, cache, lines, included):
+    for seg in fragment:
+        if "include" in seg:
+            f = seg["include"]
+            included.append(f)
+            link(cache.get(read_lines(f)), cache, lines, included)
+        elif lines:
+            lines.extend(seg["lines"])
+        else:
+            lines.append(seg["first"])
+            lines.extend(seg["lines"][1:])
+    return lines
+
+def preprocess(raw_lines, cache):
+    included = []
+    lines = link(cache.get(raw_lines), cache, [], included)
+
+    args = cache.args
+    if args.keep_rems:
+        markers = []
+        for f in included:
+            markers.append("REM vvv BEGIN '%s' vvv" % f)
+            markers.append("REM ^^^ END '%s' ^^^" % f)
+        lines.extend(fixup_lines(markers, args, bool(lines)))
+    return lines
+
+# Replace the targets of GOTO/GOSUB/THEN and of ON ... GOTO/GOSUB lists
+# with their line numbers, looking each one up in mapping (label or
+# old line number -> new line number) during a single pass over the
+# statements.
+KEYWORD_RE = re.compile(r"(?:THEN|GOTO|GOSUB) *")
+TOKEN_RE = re.compile(r"\w+")
+SPACES_RE = re.compile(r" *")
+
+def relocate_statement(stmt, mapping, mode):
+    edits = {}  # start -> (end, replacement)
+
+    # the target right after THEN/GOTO/GOSUB
+    for m in KEYWORD_RE.finditer(stmt):
+        t = TOKEN_RE.match(stmt, m.end())
+        if t and t.group() in mapping:
+            edits[t.start()] = (t.end(), mapping[t.group()])
+
+    # the other targets of an ON list (those starting a word). In cbm
+    # mode, the spaces after ON and GOTO/GOSUB are then dropped.
+    on = stmt.find("ON" if mode == "cbm" else "ON ")
+    if on >= 0:
+        for kw in ("GOTO", "GOSUB"):
+            k = stmt.rfind(kw)
+            if k < on + 2: continue
+            found = False
+            for t in TOKEN_RE.finditer(stmt, k + len(kw)):
+                if t.group() in mapping and not stmt[t.start()-1].isalnum() \
+                        and stmt[t.start()-1] != "_":
+                    edits[t.start()] = (t.end(), mapping[t.group()])
+                    found = True
+            if found and mode == "cbm":
+                for pos in (on + 2, k + len(kw)):
+                    sp = SPACES_RE.match(stmt, pos)
+                    if sp.end() > pos: edits[pos] = (sp.end(), "")
+
+    if not edits: return stmt
+    pieces, pos = [], 0
+    for start in sorted(edits):
+        end, rep = edits[start]
+        pieces.append(stmt[pos:start])
+        pieces.append(rep)
+        pos = end
+    pieces.append(stmt[pos:])
+    return "".join(pieces)
+
+def relocate(lines, mapping, mode):
+    return [":".join(relocate_statement(stmt, mapping, mode)
+                     for stmt in line.split(":"))
+            for line in lines]
 
 def finalize(lines, args):
     labels_lines = {}
@@ -216,29 +367,10 @@ def finalize(lines, args):
 
         lines.append(line)
 
-    def update_labels_lines(text, a, b):
-        stext = ""
-        while stext != text:
-            stext = text
-            text = re.sub(r"(THEN *)%s\b" % a, r"\g<1>%s" % b, stext)
-            #text = re.sub(r"(THEN)%s\b" % a, r"THEN%s" % b, stext)
-            if args.mode == "cbm":
-                text = re.sub(r"ON *([^:\n]*) *GOTO *([^:\n]*)\b%s\b" % a, r"ON\g<1>GOTO\g<2>%s" % b, text)
-                text = re.sub(r"ON *([^:\n]*) *GOSUB *([^:\n]*)\b%s\b" % a, r"ON\g<1>GOSUB\g<2>%s" % b, text)
-            else:
-                text = re.sub(r"(ON [^:\n]* *GOTO *[^:\n]*)\b%s\b" % a, r"\g<1>%s" % b, text)
-                text = re.sub(r"(ON [^:\n]* *GOSUB *[^:\n]*)\b%s\b" % a, r"\g<1>%s" % b, text)
-            text = re.sub(r"(GOSUB *)%s\b" % a, r"\g<1>%s" % b, text)
-            text = re.sub(r"(GOTO *)%s\b" % a, r"\g<1>%s" % b, text)
-            #text = re.sub(r"(GOTO)%s\b" % a, r"\1%s" % b, text)
-        return text
-
-    # search for and replace GOTO/GOSUBs
-    src_lines = lines
-    text = "\n".join(lines)
-    for label, lnum in labels_lines.items():
-        text = update_labels_lines(text, label, lnum)
-    lines = text.split("\n")
+    # replace GOTO/GOSUB targets
+    lines = relocate(lines, dict((label, str(lnum))
+                                 for label, lnum in labels_lines.items()),
+                     args.mode)
 
     # combine lines
     if not args.skip_combine_lines:
@@ -287,13 +419,9 @@ def finalize(lines, args):
             lines.append(acc_line)
 
         # Finally renumber GOTO/GOSUBS
-        src_lines = lines
-        text = "\n".join(lines)
-        # search for and replace GOTO/GOSUBs
-        for a in sorted(renumber.keys()):
-            b = renumber[a]
-            text = update_labels_lines(text, a, b)
-        lines = text.split("\n")
+        lines = relocate(lines, dict((str(a), str(b))
+                                     for a, b in renumber.items()),
+                         args.mode)
 
     # Force non-UI QBasic to use text console. LINE INPUT also needs
     # to be used instead in character-by-character READLINE
@@ -315,30 +443,13 @@ if __name__ == '__main__':
             for l in open(f).readlines()]
     debug("Original lines: %s" % len(lines))
 
-    # pull in include files
-    lines = resolve_includes(lines, args)
-    debug("Lines after includes: %s" % len(lines))
-
-    lines = resolve_mode(lines, args)
-    debug("Lines after resolving mode specific lines: %s" % len(lines))
-
-    # drop blank lines
-    if not args.keep_blank_lines:
-        lines = drop_blank_lines(lines)
-        debug("Lines after dropping blank lines: %s" % len(lines))
-
-    # keep/drop REMs
-    if not args.keep_rems:
-        lines = drop_rems(lines)
-        debug("Lines after dropping REMs: %s" % len(lines))
-
-    # keep/remove the indenting
-    if not args.keep_indent:
-        lines = remove_indent(lines)
-
-    # apply some miscellaneous simple fixups/regex transforms
-    if not args.skip_misc_fixups:
-        lines = misc_fixups(lines)
+    # pull in include files, drop/keep blank lines, REMs and indenting
+    # and apply some miscellaneous simple fixups/regex transforms
+    cache = FragmentCache(args)
+    lines = preprocess(lines, cache)
+    debug("Fragments: %s processed, %s from the cache" % (
+        cache.misses, cache.hits))
+    debug("Lines after preprocessing: %s" % len(lines))
 
     # number lines, drop/keep labels, combine lines
     lines = finalize(lines, args)
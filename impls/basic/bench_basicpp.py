@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+# Time the preprocessing of the BASIC steps by basicpp.py
+
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+clock = getattr(time, 'perf_counter', time.time)
+
+parser = argparse.ArgumentParser(description='Time basicpp.py.')
+parser.add_argument('infiles', type=str, nargs='*',
+                    default=['stepA_mal.in.bas'],
+                    help='the Basic files to preprocess')
+parser.add_argument('--mode', choices=["cbm", "qbasic"], default="cbm")
+parser.add_argument('--runs', type=int, default=5,
+                    help='number of runs per file (the best is reported)')
+parser.add_argument('--cache-dir', type=str, default=None,
+                    help='directory caching the preprocessed files')
+parser.add_argument('--python', type=str, default=sys.executable,
+                    help='Python interpreter running basicpp.py')
+args = parser.parse_args()
+
+cache_opts = ['--cache-dir', args.cache_dir] if args.cache_dir else []
+basicpp = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'basicpp.py')
+with open(os.devnull, 'w') as devnull:
+    for infile in args.infiles:
+        times = []
+        for i in range(args.runs):
+            start = clock()
+            subprocess.check_call([args.python, basicpp, '--mode', args.mode]
+                                  + cache_opts + [infile],
+                                  stdout=devnull, stderr=devnull)
+            times.append(clock() - start)
+        print("%s (%s): best %.3fs, mean %.3fs over %d runs" % (
+            infile, args.mode, min(times), sum(times) / len(times), args.runs))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# Check that the single pass misc_fixups of basicpp.py matches the
+# original sequence of substitutions on every step file.
+
+import argparse
+import glob
+import os
+import re
+import unittest
+
+import basicpp
+
+def reference_misc_fixups(orig_lines):
+    text = "\n".join(orig_lines)
+
+    # Remove GOTO after THEN
+    text = re.sub(r"\bTHEN GOTO\b", "THEN", text)
+
+    # Remove spaces after keywords
+    text = re.sub(r"\bIF ", "IF", text)
+    text = re.sub(r"\bPRINT *", "PRINT", text)
+    text = re.sub(r"\bDIM ", "DIM", text)
+    text = re.sub(r"OPEN ", "OPEN", text)
+    text = re.sub(r"\bGET ", "GET", text)
+    text = re.sub(r"\bPOKE ", "POKE", text)
+    text = re.sub(r"\bCLOSE ", "CLOSE", text)
+    text = re.sub(r"\bFOR ", "FOR", text)
+    text = re.sub(r" TO ", "TO", text)
+    text = re.sub(r"\bNEXT ", "NEXT", text)
+
+    # Remove spaces around GOTO/GOSUB/THEN
+    text = re.sub(r" *GOTO *", "GOTO", text)
+    text = re.sub(r" *GOSUB *", "GOSUB", text)
+    text = re.sub(r" *THEN *", r"THEN", text)
+
+    # Remove spaces around AND/OR except after ST
+    text = re.sub(r"(?<!ST) *AND *", r"AND", text)
+    text = re.sub(r"([^A-Z]) *OR *", r"\g<1>OR", text)
+
+    return text.split("\n")
+
+def make_args(mode, sub_mode="noui"):
+    return argparse.Namespace(
+        mode=mode, sub_mode=sub_mode, full_mode="%s-%s" % (mode, sub_mode),
+        keep_rems=False, keep_blank_lines=False, keep_indent=False,
+        skip_misc_fixups=True, skip_combine_lines=False, cache_dir=None)
+
+class MiscFixupsTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+
+    def test_step_files(self):
+        steps = sorted(glob.glob("step*.in.bas"))
+        self.assertTrue(steps)
+        for step in steps:
+            for mode, sub_mode in (("cbm", "noui"), ("qbasic", "noui"),
+                                   ("qbasic", "ui")):
+                # the lines misc_fixups is given in the pipeline
+                cache = basicpp.FragmentCache(make_args(mode, sub_mode))
+                lines = basicpp.preprocess(basicpp.read_lines(step), cache)
+                self.assertEqual(basicpp.misc_fixups(lines),
+                                 reference_misc_fixups(lines),
+                                 "%s (%s-%s)" % (step, mode, sub_mode))
+
+    def test_snippets(self):
+        for line in ["IF A THEN GOTO LOOP", "IF ST AND 64 THEN X=1",
+                     "IF A=1 OR B  OR (C) THEN PRINT \"X\"",
+                     "FOR I=1 TO 10:NEXT I", "OPEN 2,8,2:CLOSE 2",
+                     "ON G GOSUB A,B:GET C$:POKE 1,2:DIM A(1)",
+                     "OR X", "  X = A AND B", "ERROR OR"]:
+            self.assertEqual(basicpp.misc_fixups([line]),
+                             reference_misc_fixups([line]), line)
+
+if __name__ == '__main__':
+    unittest.main()
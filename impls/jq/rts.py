@@ -5,24 +5,76 @@ import json
 from os.path import dirname, realpath
 from os import environ
 import signal
+import sys
 from sys import argv
 import fcntl
+from shutil import which
 
 DEBUG = False
 HALT = False
 
 # Bestow IO upon jq
 
+# jq sends one message per line (the JSON arrays written by `debug`),
+# which are read through a buffer instead of one byte per read(2).
+# Replies are JSON texts, one per line, written whole.
+
+class Channel:
+    def __init__(self, fd_in, fd_out, size=65536):
+        self.fd_in = fd_in
+        self.fd_out = fd_out
+        self.size = size
+        self.buf = bytearray()
+        self.scanned = 0 # no newline in buf[:scanned]
+
+    def buffered(self):
+        """Is a whole message already buffered?"""
+        return self.buf.find(b"\n", self.scanned) >= 0
+
+    def read_message(self):
+        """Return the next message, or None when jq is gone."""
+        while True:
+            end = self.buf.find(b"\n", self.scanned)
+            if end >= 0:
+                msg = bytes(self.buf[:end])
+                del self.buf[:end + 1]
+                self.scanned = 0
+                return msg.decode('utf-8')
+            self.scanned = len(self.buf)
+            data = read(self.fd_in, self.size)
+            if not data:
+                if not self.buf:
+                    return None
+                msg = bytes(self.buf)
+                del self.buf[:]
+                self.scanned = 0
+                return msg.decode('utf-8')
+            self.buf += data
+
+    def send(self, value):
+        data = memoryview(bytes(json.dumps(value) + "\n", 'utf-8'))
+        while data:
+            data = data[write(self.fd_out, data):]
+
+# Text printed by jq is gathered and written out in one go when there
+# is no other message buffered (jq may be waiting on us) and before
+# anything else is shown to the user.
+
+output = []
+
+def flush_output():
+    if output:
+        sys.stdout.write("".join(output))
+        del output[:]
+    sys.stdout.flush()
+
 def _read(fname, out=None):
     with open(fname, "r") as f:
-        data = json.dumps(f.read()) + "\n"
-        # print("data =", data)
-        write(out, bytes(data, 'utf-8'))
+        out.send(f.read())
 
 def _readline(prompt="", out=None):
-    data = json.dumps(input(prompt)) + "\n"
-    # print("data =", data)
-    write(out, bytes(data, 'utf-8'))
+    flush_output()
+    out.send(input(prompt))
 
 def _fwrite(fname, data, out=None):
     return
@@ -41,28 +93,15 @@ rts = {
     "halt": _halt,
 }
 
-def process(cmd, fout):
+def process(cmd, channel):
     if type(cmd) == str:
-        print(cmd, end="")
+        output.append(cmd)
     elif type(cmd) == dict:
         cmd = cmd['command']
         command = cmd['cmd']
         args = cmd['args']
         fn = rts.get(command, stub)
-        fn(*args, out=fout)
-
-def get_one(fd):
-    s = b""
-    while True:
-        x = read(fd, 1)
-        if x == b'\n':
-            break
-        if x == b'':
-            break
-        s += x
-    if s == "":
-        return None
-    return s.decode('utf-8')
+        fn(*args, out=channel)
 
 
 def main(args):
@@ -87,26 +126,36 @@ def main(args):
         dup2(sout_pipe[1], 2) # bind to stderr, as we write there
         dup2(sout_pipe[1], 1)
 
+        # jq writes its messages to the unbuffered stderr a few bytes
+        # at a time: have it line buffered when stdbuf is available
+        stdbuf = which("stdbuf")
+        if stdbuf:
+            execv(stdbuf, ["stdbuf", "-eL", "/usr/bin/jq"] + args[1:])
         execv("/usr/bin/jq", args)
     else:
         close(sin_pipe[0])
         close(sout_pipe[1])
 
-        msout = sin_pipe[1]
-        msin = sout_pipe[0]
+        channel = Channel(sout_pipe[0], sin_pipe[1])
 
         while True:
             try:
                 if HALT:
                     break
-                cmd = get_one(msin)
+                if not channel.buffered():
+                    flush_output()
+                cmd = channel.read_message()
                 # print(cmd)
+                if cmd is None:
+                    break
                 if cmd:
-                    process(json.loads(cmd)[1], msout)
+                    process(json.loads(cmd)[1], channel)
             except KeyboardInterrupt:
+                flush_output()
                 exit()
             except Exception as e:
-                print("RTS Error:", e)
+                output.append("RTS Error: %s\n" % e)
+        flush_output()
 
 
 main(argv[1:])
@@ -401,6 +401,7 @@ ns = {
     "symbol?": MalFunctionCompiled(lambda args: symbol_q(args[0])),
     "readline": MalFunctionCompiled(lambda args: readline(args[0])),
     "time-ms": MalFunctionCompiled(lambda args: MalInt(int(time.time() * 1000))),
+    "time-ns": MalFunctionCompiled(lambda args: MalInt(time.perf_counter_ns())),
     "meta": MalFunctionCompiled(lambda args: not_implemented("meta")),
     "with-meta": MalFunctionCompiled(lambda args: not_implemented("with-meta")),
     "fn?": MalFunctionCompiled(lambda args: not_implemented("fn?")),
@@ -1,5 +1,6 @@
-import copy, time
-from itertools import chain
+import copy, functools, multiprocessing, os, sys, threading, time, weakref
+from itertools import chain, count as _count
+from collections import OrderedDict
 
 import mal_types as types
 from mal_types import MalException, List, Vector
@@ -26,6 +27,11 @@ def println(*args):
     print(" ".join(map(lambda exp: printer._pr_str(exp, False), args)))
     return None
 
+def pprint(obj, width=0):
+    printer._pprint(obj, sys.stdout, width)
+    sys.stdout.write("\n")
+    return None
+
 
 # Hash map functions
 def assoc(src_hm, *key_vals):
@@ -55,35 +61,48 @@ def vals(hm): return types._list(*hm.values())
 # Sequence functions
 def coll_Q(coll): return sequential_Q(coll) or hash_map_Q(coll)
 
-def cons(x, seq): return List([x]) + List(seq)
+def cons(x, seq):
+    if types._lazy_seq_Q(seq): return types.LazySeq(chain([x], seq))
+    return List([x]) + List(seq)
 
 def concat(*lsts): return List(chain(*lsts))
 
 def nth(lst, idx):
+    if types._lazy_seq_Q(lst):
+        try: return lst[idx]
+        except IndexError: throw("nth: index out of range")
     if idx < len(lst): return lst[idx]
     else: throw("nth: index out of range")
 
 def first(lst):
     if types._nil_Q(lst): return None
+    elif types._lazy_seq_Q(lst): return None if lst.empty() else lst[0]
     else: return lst[0]
 
 def rest(lst):
     if types._nil_Q(lst): return List([])
+    elif types._lazy_seq_Q(lst): return lst.rest()
     else: return List(lst[1:])
 
-def empty_Q(lst): return len(lst) == 0
+def empty_Q(lst):
+    if types._lazy_seq_Q(lst): return lst.empty()
+    return len(lst) == 0
+
+def list_Q(obj): return types._list_Q(obj) or types._lazy_seq_Q(obj)
 
 def count(lst):
     if types._nil_Q(lst): return 0
     else: return len(lst)
 
-def apply(f, *args): return f(*(list(args[0:-1])+args[-1]))
+def apply(f, *args): return f(*(list(args[0:-1])+list(args[-1])))
 
 def mapf(f, lst): return List(map(f, lst))
 
 # retains metadata
 def conj(lst, *args):
-    if types._list_Q(lst): 
+    if types._lazy_seq_Q(lst):
+        return types.LazySeq(chain(reversed(args), lst))
+    elif types._list_Q(lst):
         new_lst = List(list(reversed(list(args))) + lst)
     else:
         new_lst = Vector(lst + list(args))
@@ -98,10 +117,71 @@ def seq(obj):
         return List(obj) if len(obj) > 0 else None
     elif types._string_Q(obj):
         return List([c for c in obj]) if len(obj) > 0 else None
+    elif types._lazy_seq_Q(obj):
+        return None if obj.empty() else obj
     elif obj == None:
         return None
     else: throw ("seq: called on non-sequence")
 
+# Reduction functions
+
+# Folds iterate in place and stop as soon as f returns a reduced value
+def reduce(f, init, xs):
+    acc = init
+    for x in xs or ():
+        acc = f(acc, x)
+        if type(acc) == types.Reduced: return acc.val
+    return acc
+
+def foldr(f, init, xs):
+    acc = init
+    for x in reversed(xs or ()):
+        acc = f(x, acc)
+        if type(acc) == types.Reduced: return acc.val
+    return acc
+
+def ensure_reduced(x):
+    return x if type(x) == types.Reduced else types._reduced(x)
+
+# Transducers turn a reducing function (acc x -> acc) into another one
+def mapping(f):
+    return lambda rf: lambda acc, x: rf(acc, f(x))
+
+def filtering(pred):
+    def xf(rf):
+        def step(acc, x):
+            keep = pred(x)
+            if keep is None or keep is False: return acc
+            return rf(acc, x)
+        return step
+    return xf
+
+def taking(n):
+    def xf(rf):
+        left = [n]
+        def step(acc, x):
+            left[0] -= 1
+            if left[0] > 0:  return rf(acc, x)
+            if left[0] == 0: return ensure_reduced(rf(acc, x))
+            return types._reduced(acc)
+        return step
+    return xf
+
+def transduce(xf, f, init, xs): return reduce(xf(f), init, xs)
+
+def _append(acc, x):
+    acc.append(x)
+    return acc
+
+# (into to xs) or (into to xf xs)
+def into(to, *args):
+    rf = args[0](_append) if len(args) > 1 else _append
+    items = reduce(rf, [], args[-1])
+    if types._hash_map_Q(to):
+        return assoc(to, *chain(*items))
+    return conj(to, *items)
+
+
 # Metadata functions
 def with_meta(obj, meta):
     new_obj = types._clone(obj)
@@ -112,14 +192,339 @@ def meta(obj):
     return getattr(obj, "__meta__", None)
 
 
+# Time functions
+
+# Monotonic high resolution clock (time-ms stays the wall clock)
+if hasattr(time, 'perf_counter_ns'):
+    time_ns = time.perf_counter_ns
+elif hasattr(time, 'perf_counter'):
+    def time_ns(): return int(time.perf_counter() * 1000000000)
+else:
+    def time_ns(): return int(time.time() * 1000000000)
+
+perf_counter = getattr(time, 'perf_counter', time.time)
+
+
+# Memoization
+
+# Cache results by the structure of the arguments, keeping at most
+# max_size of the most recently used ones when a size is given
+def memoize(f, max_size=None):
+    cache = OrderedDict()
+    stats = {'hits': 0, 'misses': 0}
+    def memoized(*args):
+        try:
+            key = tuple(types.Key(a) for a in args)
+            ret = cache.pop(key)
+        except KeyError:
+            pass
+        except TypeError:   # unhashable host object, don't cache
+            return f(*args)
+        else:
+            stats['hits'] += 1
+            cache[key] = ret
+            return ret
+        stats['misses'] += 1
+        ret = f(*args)
+        cache[key] = ret
+        if max_size is not None and len(cache) > max_size:
+            cache.popitem(last=False)
+        return ret
+    memoized.__meta__ = None
+    memoized.__memo__ = (cache, stats, max_size)
+    return memoized
+
+def memoize_stats(f):
+    if not hasattr(f, '__memo__'):
+        throw("memoize-stats: not a memoized function")
+    cache, stats, max_size = f.__memo__
+    return types._hash_map(types._keyword('hits'), stats['hits'],
+                           types._keyword('misses'), stats['misses'],
+                           types._keyword('size'), len(cache),
+                           types._keyword('max-size'), max_size)
+
+
+# Protocols (see lib/protocols.mal)
+
+_type_keywords = dict((t, types._keyword(u'mal/' + t)) for t in (
+    'symbol', 'keyword', 'atom', 'nil', 'boolean', 'number', 'string',
+    'macro', 'list', 'vector', 'map', 'function'))
+_type_key = types._keyword(u'type')
+
+def find_type(obj):
+    kw = _type_keywords
+    if types._symbol_Q(obj):  return kw['symbol']
+    if types._keyword_Q(obj): return kw['keyword']
+    if types._atom_Q(obj):    return kw['atom']
+    if obj is None:           return kw['nil']
+    if type(obj) == bool:     return kw['boolean']
+    if types._number_Q(obj):  return kw['number']
+    if types._string_Q(obj):  return kw['string']
+    if types._function_Q(obj) and getattr(obj, '_ismacro_', False):
+        return kw['macro']
+    metadata = getattr(obj, '__meta__', None)
+    if types._hash_map_Q(metadata):
+        t = metadata.get(_type_key)
+        if types._keyword_Q(t):    return t
+    if types._list_Q(obj):     return kw['list']
+    if types._vector_Q(obj):   return kw['vector']
+    if types._hash_map_Q(obj): return kw['map']
+    if types._function_Q(obj): return kw['function']
+    throw("unknown MAL value in protocols")
+
+# Dispatch a method of a protocol (an atom mapping types to maps from
+# method names to implementations) on the type of the first argument.
+# Implementations found are cached per type until the protocol changes.
+def protocol_method(proto, name):
+    cache = {}
+    table = [None]
+    def dispatch(this, *args):
+        methods = proto.val
+        if methods is not table[0]:
+            cache.clear()
+            table[0] = methods
+        t = find_type(this)
+        f = cache.get(t)
+        if f is None:
+            f = (methods.get(t) or {}).get(name)
+            if f is None:
+                throw("no method %s for type %s" % (
+                    printer._pr_str(name), printer._pr_str(t)))
+            cache[t] = f
+        return f(this, *args)
+    dispatch.__meta__ = None
+    return dispatch
+
+
+# Counters and symbol generation
+def counter_inc_BANG(ctr, n=1): return ctr.inc(n)
+
+# next() on itertools.count is atomic
+_gensym_ids = _count(1)
+def gensym(prefix=u"G__"):
+    return types._symbol(prefix + str(next(_gensym_ids)))
+
+
 # Atoms functions
-def deref(atm):    return atm.val
-def reset_BANG(atm,val):
-    atm.val = val
+def deref(atm):
+    if types._future_Q(atm): return atm.fut.result()
     return atm.val
+def reset_BANG(atm,val): return atm.reset(val)
+# f may run several times when other threads change the atom meanwhile
 def swap_BANG(atm,f,*args):
-    atm.val = f(atm.val,*args)
-    return atm.val
+    while True:
+        old = atm.val
+        new = f(old,*args)
+        if atm.compare_and_set(old, new):
+            return new
+
+
+# Futures and parallel map
+#
+# Futures and pmap run on a pool of MAL_THREADS threads (the number of
+# CPUs by default). With MAL_POOL=process, pmap runs in forked
+# processes instead, so that CPU-bound functions are not held back by
+# the GIL: arguments and results are passed through the printer and the
+# reader, and must print readably. Work started from a pool thread is
+# done in place rather than waiting on the pool it occupies.
+try:
+    from concurrent.futures import Future as _Future, ThreadPoolExecutor
+    from concurrent.futures import TimeoutError as _TimeoutError
+except ImportError:
+    # Python 2: futures (and promises) are completed by whoever
+    # computes them, and pmap runs in place
+    ThreadPoolExecutor = None
+    class _TimeoutError(Exception): pass
+    class _Future(object):
+        def __init__(self):
+            self.event = threading.Event()
+            self.val = self.exc = None
+        def set_result(self, val):
+            self.val = val
+            self.event.set()
+        def set_exception(self, exc):
+            self.exc = exc
+            self.event.set()
+        def done(self): return self.event.is_set()
+        def result(self, timeout=None):
+            if not self.event.wait(timeout): raise _TimeoutError()
+            if self.exc is not None: raise self.exc
+            return self.val
+
+_pool = None
+_pool_lock = threading.Lock()
+_in_pool = threading.local()
+
+def _pool_size():
+    try:
+        return max(1, int(os.environ.get("MAL_THREADS", "")))
+    except ValueError:
+        return multiprocessing.cpu_count()
+
+def _thread_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(_pool_size())
+        return _pool
+
+def _pool_call(f, args):
+    _in_pool.active = True
+    try:
+        return f(*args)
+    finally:
+        _in_pool.active = False
+
+def _done_future(f, args):
+    fut = _Future()
+    try:
+        fut.set_result(f(*args))
+    except Exception as e:
+        fut.set_exception(e)
+    return fut
+
+def future_call(f):
+    if ThreadPoolExecutor is None or getattr(_in_pool, 'active', False):
+        return types.Future(_done_future(f, ()))
+    return types.Future(_thread_pool().submit(_pool_call, f, ()))
+
+def future_done_Q(fut): return fut.fut.done()
+
+# Promises are futures completed by deliver
+def promise(): return types.Future(_Future())
+def deliver(p, val):
+    p.fut.set_result(val)
+    return p
+
+# Deref waiting at most timeout milliseconds, then returning default
+def await_(fut, timeout=None, default=None):
+    if timeout is None: return fut.fut.result()
+    try:
+        return fut.fut.result(timeout / 1000.0)
+    except _TimeoutError:
+        return default
+
+# With MAL_POOL=process, pmap maps on a pool of forked processes kept
+# for the life of the process. Functions cannot be sent to the workers:
+# each mapped function is registered under a key, the workers inherit
+# the registry when they are forked and the tasks carry the key. A
+# function the workers do not know yet replaces the pool with a new one.
+_process_lock = threading.Lock()
+_process_pool = None
+_process_pool_fns = {}                        # what the workers know
+_process_fns = weakref.WeakValueDictionary()  # key -> function
+_process_keys = weakref.WeakKeyDictionary()   # function -> key
+_process_builtins = {}
+_process_count = _count(1)
+
+def _process_key(f):
+    try:
+        weakref.ref(f)
+    except TypeError:
+        # builtins have no weak references: register a wrapper
+        f = _process_builtins.setdefault(f, functools.partial(f))
+    key = _process_keys.get(f)
+    if key is None:
+        key = _process_keys[f] = next(_process_count)
+        _process_fns[key] = f
+    return key
+
+def _process_call(key, args):
+    _in_pool.active = True
+    f = _process_pool_fns[key]
+    return printer._pr_str(f(*reader.read_str(args)), True)
+
+def _process_map(f, args):
+    global _process_pool, _process_pool_fns
+    from concurrent.futures import ProcessPoolExecutor
+    with _process_lock:
+        key = _process_key(f)
+        if key not in _process_pool_fns:
+            if _process_pool is not None:
+                _process_pool.shutdown()
+            _process_pool_fns = dict(_process_fns)
+            _process_pool = ProcessPoolExecutor(
+                _pool_size(), mp_context=multiprocessing.get_context("fork"))
+        futs = [_process_pool.submit(_process_call, key,
+                                     printer._pr_str(List(a), True))
+                for a in args]
+    return [reader.read_str(fut.result()) for fut in futs]
+
+def pmap(f, *colls):
+    args = list(zip(*colls))
+    if ThreadPoolExecutor is None or getattr(_in_pool, 'active', False) \
+            or len(args) < 2:
+        return List([f(*a) for a in args])
+    if os.environ.get("MAL_POOL") == "process":
+        return List(_process_map(f, args))
+    pool = _thread_pool()
+    return List(pool.map(_pool_call, [f] * len(args), args))
+
+
+# Asynchronous I/O
+#
+# slurp-async and spit-async return promises. They are started by an
+# asyncio event loop running in a background thread, which hands the
+# blocking file operations to its executor so that many of them
+# overlap. Without asyncio (Python 2), they complete right away.
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def _event_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            t = threading.Thread(target=_loop.run_forever, name="mal-io")
+            t.daemon = True
+            t.start()
+        return _loop
+
+def _start_io(fn, *args):
+    if asyncio is None:
+        return types.Future(_done_future(fn, args))
+    fut = _Future()
+    def resolve(task):
+        if task.exception() is not None:
+            fut.set_exception(task.exception())
+        else:
+            fut.set_result(task.result())
+    loop = _event_loop()
+    loop.call_soon_threadsafe(
+        lambda: loop.run_in_executor(None, fn, *args).add_done_callback(resolve))
+    return types.Future(fut)
+
+def _read_file(path):
+    with open(path) as f:
+        return f.read()
+
+def _write_file(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
+def slurp_async(path): return _start_io(_read_file, path)
+def spit_async(path, content): return _start_io(_write_file, path, content)
+
+# Python interop
+def py_seq(obj):
+    if obj is None: return List([])
+    if types._lazy_seq_Q(obj): return obj
+    return types.LazySeq(iter(obj))
+
+def py_get(obj, attr):
+    return types.py_to_mal(getattr(obj, attr))
+
+def py_apply(f, args, kwargs=None):
+    kw = {}
+    if kwargs:
+        for k, v in kwargs.items():
+            kw[k[1:] if types._keyword_Q(k) else k] = v
+    return types.py_to_mal(f(*args, **kw))
 
 
 ns = { 
@@ -143,6 +548,7 @@ ns = {
         'str': do_str,
         'prn': prn,
         'println': println,
+        'pprint': pprint,
         'readline': lambda prompt: mal_readline.readline(prompt),
         'read-string': reader.read_str,
         'slurp': lambda file: open(file).read(),
@@ -155,9 +561,11 @@ ns = {
         '*':  lambda a,b: a*b,
         '/':  lambda a,b: int(a/b),
         'time-ms': lambda : int(time.time() * 1000),
+        'time-ns': time_ns,
+        'perf-counter': perf_counter,
 
         'list': types._list,
-        'list?': types._list_Q,
+        'list?': list_Q,
         'vector': types._vector,
         'vector?': types._vector_Q,
         'hash-map': types._hash_map,
@@ -180,15 +588,47 @@ ns = {
         'count': count,
         'apply': apply,
         'map': mapf,
+        'reduce': reduce,
+        'foldr': foldr,
+        'reduced': types._reduced,
+        'reduced?': types._reduced_Q,
+        'mapping': mapping,
+        'filtering': filtering,
+        'taking': taking,
+        'transduce': transduce,
+        'into': into,
 
         'conj': conj,
         'seq': seq,
 
+        'find-type': find_type,
+        'protocol-method': protocol_method,
+
+        'memoize': memoize,
+        'memoize-stats': memoize_stats,
+
         'with-meta': with_meta,
         'meta': meta,
+        'gensym': gensym,
+        'counter': types._counter,
+        'counter?': types._counter_Q,
+        'counter-inc!': counter_inc_BANG,
         'atom': types._atom,
         'atom?': types._atom_Q,
         'deref': deref,
         'reset!': reset_BANG,
-        'swap!': swap_BANG}
+        'swap!': swap_BANG,
+        'future-call': future_call,
+        'future?': types._future_Q,
+        'future-done?': future_done_Q,
+        'pmap': pmap,
+        'promise': promise,
+        'promise?': types._future_Q,
+        'deliver': deliver,
+        'await': await_,
+        'slurp-async': slurp_async,
+        'spit-async': spit_async,
+        'py-seq': py_seq,
+        'py-get': py_get,
+        'py-apply': py_apply}
 
@@ -1,3 +1,7 @@
+from itertools import islice
+from mal_types import Symbol, List, Vector, Hash_Map, LazySeq, _keyword
+import printer
+
 # Environment
 
 class Env():
@@ -26,3 +30,106 @@ class Env():
         env = self.find(key)
         if not env: raise Exception("'" + key + "' not found")
         return env.data[key]
+
+# Destructuring
+#
+# let* and fn* (from stepA) also bind sequential forms [a b & more :as
+# all] to the elements of a sequence (nil when missing) and map forms
+# {:keys [a b] :strs [d] c :c :as all} to values of a map. Each form is compiled
+# once into a binding plan, a function (env, value) cached on the form.
+
+def bind_plan(form):
+    if type(form) == Symbol:
+        return lambda env, value: env.set(form, value)
+    plan = form.__dict__.get('__plan__')
+    if plan is None:
+        if type(form) == Hash_Map: plan = _map_plan(form)
+        else:                      plan = _seq_plan(form)
+        form.__plan__ = plan
+    return plan
+
+_kw_as = _keyword(u'as')
+_kw_keys = _keyword(u'keys')
+_kw_strs = _keyword(u'strs')
+
+def _check_map_key(k):
+    if type(k) not in (Symbol, List, Vector, Hash_Map):
+        raise Exception("unsupported map destructuring key: "
+                        + printer._pr_str(k))
+
+def _seq_plan(form):
+    items, as_name, more = list(form), None, None
+    if len(items) >= 2 and items[-2] == _kw_as:
+        as_name = items[-1]
+        items = items[:-2]
+    if len(items) >= 2 and items[-2] == u'&':
+        more = bind_plan(items[-1])
+        items = items[:-2]
+    plans = [bind_plan(f) for f in items]
+    n = len(plans)
+    def bind(env, value):
+        if value is None:
+            seq = ()
+        elif type(value) == LazySeq:
+            # only realize the items that are bound
+            seq = List(islice(value, n)) if more is None else value
+        elif type(value) in (List, Vector):
+            seq = value
+        else:
+            raise Exception("cannot destructure %s as a sequence"
+                            % printer._pr_str(value))
+        m = len(seq)
+        for i in range(n):
+            plans[i](env, seq[i] if i < m else None)
+        if more: more(env, List(seq[n:]))
+        if as_name: env.set(as_name, value)
+    return bind
+
+def _map_plan(form):
+    pairs, as_name = [], None
+    for k, v in form.items():
+        if k == _kw_keys:
+            pairs.extend((bind_plan(s), _keyword(s)) for s in v)
+        elif k == _kw_strs:
+            pairs.extend((bind_plan(s), u'' + s) for s in v)
+        elif k == _kw_as:
+            as_name = v
+        else:
+            _check_map_key(k)
+            pairs.append((bind_plan(k), v))
+    def bind(env, value):
+        if value is not None and type(value) != Hash_Map:
+            raise Exception("cannot destructure %s as a map"
+                            % printer._pr_str(value))
+        for plan, key in pairs:
+            plan(env, value.get(key) if value is not None else None)
+        if as_name: env.set(as_name, value)
+    return bind
+
+def pattern_symbols(form):
+    """Symbols bound by a binding form."""
+    if type(form) == Symbol:
+        return set([form])
+    syms = set()
+    if type(form) == Hash_Map:
+        for k, v in form.items():
+            if k == _kw_keys or k == _kw_strs: syms.update(v)
+            elif k == _kw_as: syms.add(v)
+            else:
+                _check_map_key(k)
+                syms |= pattern_symbols(k)
+    else:
+        for f in form:
+            if f != u'&' and f != _kw_as: syms |= pattern_symbols(f)
+    return syms
+
+def fn_env(params):
+    """Environment constructor for a function with these parameters."""
+    if all(type(p) == Symbol for p in params):
+        return Env
+    plan = bind_plan(params)
+    def make_env(outer, binds, exprs):
+        env = Env(outer)
+        plan(env, exprs)
+        return env
+    return make_env
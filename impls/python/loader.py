@@ -0,0 +1,97 @@
+import os, sys, hashlib, pickle
+import reader
+
+# Parsed forms of loaded files are cached on disk, like .pyc files, in
+# a single per-user directory: $MAL_CACHE_DIR, by default mal/python
+# under $XDG_CACHE_HOME (~/.cache). Set MAL_CACHE_DIR to an empty
+# string to disable the cache. An entry is used as is when the size and
+# mtime of the file are unchanged, and after checking the hash of the
+# contents otherwise.
+CACHE_VERSION = 1
+
+# canonical path -> (mtime, size, form) for files read by this process
+forms = {}
+# canonical paths of the files loaded by load-file-once
+loaded = set()
+
+def canonical(filename):
+    return os.path.normcase(os.path.realpath(filename))
+
+def cache_root():
+    root = os.environ.get("MAL_CACHE_DIR")
+    if root is None:
+        xdg = (os.environ.get("XDG_CACHE_HOME") or
+               os.path.join(os.path.expanduser("~"), ".cache"))
+        root = os.path.join(xdg, "mal", "python")
+    return root
+
+def cache_path(path):
+    root = cache_root()
+    if root == "":
+        return None
+    # tell apart files with the same name
+    digest = hashlib.sha1(path.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(root, digest + "-" + os.path.basename(path) + ".pickle")
+
+def load_entry(cpath):
+    try:
+        with open(cpath, "rb") as f:
+            entry = pickle.load(f)
+    except Exception:
+        return None
+    if (type(entry) != dict or entry.get("version") != CACHE_VERSION or
+            entry.get("python") != sys.version_info[0]):
+        return None
+    return entry
+
+def store_entry(cpath, entry):
+    # failing to write the cache only makes the next start slower
+    tmp = "%s.%d.tmp" % (cpath, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(cpath)):
+            os.makedirs(os.path.dirname(cpath))
+        with open(tmp, "wb") as f:
+            pickle.dump(entry, f, 2)
+        os.rename(tmp, cpath)
+    except Exception:
+        try: os.remove(tmp)
+        except OSError: pass
+
+def read_file(filename):
+    """Return the contents of a file read as a single (do ... nil)
+    form, from the caches when they are still valid."""
+    path = canonical(filename)
+    st = os.stat(path)
+    mtime, size = st.st_mtime, st.st_size
+    cached = forms.get(path)
+    if cached and cached[0] == mtime and cached[1] == size:
+        return cached[2]
+
+    cpath = cache_path(path)
+    entry = cpath and load_entry(cpath)
+    if entry and entry["mtime"] == mtime and entry["size"] == size:
+        form = entry["form"]
+    else:
+        with open(path, "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha1(raw).hexdigest()
+        src = raw.decode("utf-8") if sys.version_info[0] >= 3 else raw
+        if entry and entry["sha1"] == digest:
+            form = entry["form"]
+        else:
+            form = reader.read_str("(do " + src + "\nnil)")
+        if cpath:
+            store_entry(cpath, {"version": CACHE_VERSION,
+                                "python": sys.version_info[0],
+                                "mtime": mtime, "size": size,
+                                "sha1": digest, "form": form})
+    forms[path] = (mtime, size, form)
+    return form
+
+def mark_loaded(filename):
+    """Register a file as loaded. Return False if it already was."""
+    path = canonical(filename)
+    if path in loaded:
+        return False
+    loaded.add(path)
+    return True
@@ -1,32 +1,157 @@
-import os, sys, readline as pyreadline
+import atexit, os, sys, json, threading, readline as pyreadline
+from collections import deque
+
+# History is read, when stdin is a terminal, on the first prompt and
+# only for its last MAL_HISTORY_SIZE lines. New lines are appended in
+# batches: at exit, MAL_HISTORY_FLUSH seconds after the first line of
+# a batch (by a timer thread) and every FLUSH_LINES lines. The file is
+# cut back to MAL_HISTORY_SIZE lines when it grows to twice that.
+def env_number(name, default, kind=int):
+    try:
+        return kind(os.environ.get(name, default))
+    except ValueError:
+        return default
 
 history_loaded = False
 histfile = os.path.expanduser("~/.mal-history")
+history_size = env_number("MAL_HISTORY_SIZE", 1000)
+flush_secs = env_number("MAL_HISTORY_FLUSH", 5, float)
+FLUSH_LINES = 100
+
+pending = []
+pending_lock = threading.Lock()
+flush_timer = None
+file_lines = None # lines in histfile, once known
 if sys.version_info[0] >= 3:
     rl = input
+    from io import StringIO
 else:
     rl = raw_input
+    from StringIO import StringIO
+
+# Line-delimited JSON test protocol (runtest.py --batch). Requests are
+# {"id": N, "form": "..."}, each answered by {"id": N, "out": "..."}
+# where "out" is everything the REPL printed while evaluating it.
+# {"id": N, "reset": true} goes back to the state of the first prompt:
+# that process is kept as a template and the REPL runs in a forked
+# child, which exits on reset so that a fresh one can be forked.
+RESET_STATUS = 75
+
+class Batch():
+    def __init__(self):
+        self.stdin = sys.stdin
+        self.stdout = sys.stdout
+        self.capture = StringIO()
+        sys.stdout = sys.stderr = self.capture
+        self.current = None
+        can_fork = hasattr(os, "fork")
+        self.send({"protocol": "mal-batch", "version": 1, "reset": can_fork})
+        if can_fork: self.serve_forks()
+
+    def serve_forks(self):
+        while True:
+            pid = os.fork()
+            if pid == 0: return
+            _, status = os.waitpid(pid, 0)
+            if not os.WIFEXITED(status):
+                os._exit(1)
+            if os.WEXITSTATUS(status) != RESET_STATUS:
+                os._exit(os.WEXITSTATUS(status))
+
+    def send(self, msg):
+        msg["out"] = self.capture.getvalue()
+        self.capture.seek(0)
+        self.capture.truncate()
+        self.stdout.write(json.dumps(msg) + "\n")
+        self.stdout.flush()
+
+    def readline(self):
+        if self.current is not None:
+            self.send({"id": self.current})
+        line = self.stdin.readline()
+        if not line:
+            self.current = None
+            return None
+        req = json.loads(line)
+        if req.get("reset"):
+            self.send({"id": req["id"]})
+            os._exit(RESET_STATUS)
+        self.current = req["id"]
+        return req["form"]
+
+batch = None
+
+def load_history():
+    try:
+        with open(histfile, "r") as hf:
+            for line in deque(hf, history_size):
+                pyreadline.add_history(line.rstrip("\r\n"))
+    except IOError:
+        #print("Could not open %s" % histfile)
+        pass
+
+def flush_history():
+    global flush_timer
+    with pending_lock:
+        if flush_timer is not None:
+            flush_timer.cancel()
+            flush_timer = None
+        lines = pending[:]
+        del pending[:]
+        if lines: write_history(lines)
+
+def write_history(new_lines):
+    global file_lines
+    try:
+        if file_lines is None:
+            try:
+                with open(histfile, "r") as hf:
+                    file_lines = sum(1 for _ in hf)
+            except IOError:
+                file_lines = 0
+        if file_lines + len(new_lines) > 2 * history_size:
+            try:
+                with open(histfile, "r") as hf:
+                    lines = deque(hf, history_size)
+            except IOError:
+                lines = deque(maxlen=history_size)
+            lines.extend(l + "\n" for l in new_lines)
+            with open(histfile, "w") as hf:
+                hf.writelines(lines)
+            file_lines = len(lines)
+        else:
+            with open(histfile, "a") as hf:
+                hf.writelines(l + "\n" for l in new_lines)
+            file_lines += len(new_lines)
+    except IOError:
+        pass
+
+atexit.register(flush_history)
 
 def readline(prompt="user> "):
-    global history_loaded
-    if not history_loaded:
+    global history_loaded, batch, flush_timer
+    if os.environ.get("MAL_BATCH") == "1":
+        if not batch: batch = Batch()
+        return batch.readline()
+
+    interactive = sys.stdin.isatty()
+    if not history_loaded and interactive:
         history_loaded = True
-        try:
-            with open(histfile, "r") as hf:
-                for line in hf.readlines():
-                    pyreadline.add_history(line.rstrip("\r\n"))
-                    pass
-        except IOError:
-            #print("Could not open %s" % histfile)
-            pass
+        load_history()
 
     try:
         line = rl(prompt)
-        pyreadline.add_history(line)
-        with open(histfile, "a") as hf:
-            hf.write(line + "\n")
-    except IOError:
-        pass
     except EOFError:
+        flush_history()
         return None
+    if interactive:
+        pyreadline.add_history(line)
+    with pending_lock:
+        pending.append(line)
+        full = len(pending) >= FLUSH_LINES
+        if not full and flush_timer is None:
+            flush_timer = threading.Timer(flush_secs, flush_history)
+            flush_timer.daemon = True
+            flush_timer.start()
+    if full: flush_history()
     return line
@@ -1,4 +1,5 @@
-import sys, copy, types as pytypes
+import sys, copy, threading, types as pytypes
+from itertools import islice
 
 # python 3.0 differences
 if sys.hexversion > 0x3000000:
@@ -17,30 +18,91 @@ else:
 # General functions
 
 def _equal_Q(a, b):
-    ota, otb = type(a), type(b)
-    if _string_Q(a) and _string_Q(b):
-        return a == b
-    if not (ota == otb or (_sequential_Q(a) and _sequential_Q(b))):
-        return False;
-    if _symbol_Q(a):
-        return a == b
-    elif _list_Q(a) or _vector_Q(a):
-        if len(a) != len(b): return False
-        for i in range(len(a)):
-            if not _equal_Q(a[i], b[i]): return False
-        return True
-    elif _hash_map_Q(a):
-        akeys = sorted(a.keys())
-        bkeys = sorted(b.keys())
-        if len(akeys) != len(bkeys): return False
-        for i in range(len(akeys)):
-            if akeys[i] != bkeys[i]: return False
-            if not _equal_Q(a[akeys[i]], b[bkeys[i]]): return False
-        return True
+    # Iterate over an explicit list of pairs still to compare, and skip
+    # pairs of identical objects or of collections with known hashes
+    pairs = [(a, b)]
+    while pairs:
+        a, b = pairs.pop()
+        if a is b: continue
+        ta, tb = type(a), type(b)
+        if ta == LazySeq or tb == LazySeq:
+            # item by item, so that a lazy sequence is realized no
+            # further than the length of the other sequence
+            if not (_sequential_Q(a) and _sequential_Q(b)):
+                return False
+            items, ib = [], iter(b)
+            for x in a:
+                y = next(ib, _missing)
+                if y is _missing: return False
+                items.append((x, y))
+            if next(ib, _missing) is not _missing: return False
+            pairs.extend(reversed(items))
+        elif ta == List or ta == Vector:
+            if not (tb == List or tb == Vector) or len(a) != len(b):
+                return False
+            if _known_hashes_differ(a, b): return False
+            pairs.extend(zip(reversed(a), reversed(b)))
+        elif ta == Hash_Map:
+            if tb != Hash_Map or len(a) != len(b):
+                return False
+            if _known_hashes_differ(a, b): return False
+            for k, v in a.items():
+                if k not in b: return False
+                pairs.append((v, b[k]))
+        elif ta != tb and not (ta in str_types and tb in str_types):
+            return False
+        elif a != b:
+            return False
+    return True
+
+_missing = object()
+
+def _sequential_Q(seq):
+    return _list_Q(seq) or _vector_Q(seq) or _lazy_seq_Q(seq)
+
+# Hash consistent with `=` (lists and vectors alike, symbols apart from
+# strings, booleans apart from numbers), cached in collections
+def _hash(obj):
+    t = type(obj)
+    if t == LazySeq:
+        return hash((List, tuple(_hash(e) for e in obj)))
+    elif t == List or t == Vector or t == Hash_Map:
+        h = obj.__dict__.get('_hash_')
+        if h is None:
+            if t == Hash_Map:
+                h = hash(frozenset((k, _hash(v)) for k, v in obj.items()))
+            else:
+                h = hash((List, tuple(_hash(e) for e in obj)))
+            obj._hash_ = h
+        return h
+    elif t == Symbol or t == bool:
+        return hash((t, obj))
     else:
-        return a == b
+        return hash(obj)
 
-def _sequential_Q(seq): return _list_Q(seq) or _vector_Q(seq)
+def _known_hashes_differ(a, b):
+    ha, hb = a.__dict__.get('_hash_'), b.__dict__.get('_hash_')
+    return ha is not None and hb is not None and ha != hb
+
+# Dictionary key standing for a value: keys are equal when the values
+# are `=`
+class Key(object):
+    __slots__ = ('obj', 'hash')
+    def __init__(self, obj):
+        self.obj = obj
+        self.hash = _hash(obj)
+    def __hash__(self): return self.hash
+    def __eq__(self, other): return _equal_Q(self.obj, other.obj)
+    def __ne__(self, other): return not _equal_Q(self.obj, other.obj)
+
+# Copies of collections are usually modified (assoc, dissoc..): keep
+# their metadata but not their hash or the caches of the evaluator
+# (__plan__, __expanded__, __py__)
+def _copy_collection(obj):
+    new = type(obj)(obj)
+    if '__meta__' in obj.__dict__:
+        new.__meta__ = obj.__meta__
+    return new
 
 def _clone(obj):
     #if type(obj) == type(lambda x:x):
@@ -104,6 +166,7 @@ def _function_Q(f):
 
 # lists
 class List(list):
+    __copy__ = _copy_collection
     def __add__(self, rhs): return List(list.__add__(self, rhs))
     def __getitem__(self, i):
         if type(i) == slice: return List(list.__getitem__(self, i))
@@ -116,6 +179,7 @@ def _list_Q(exp):   return type(exp) == List
 
 # vectors
 class Vector(list):
+    __copy__ = _copy_collection
     def __add__(self, rhs): return Vector(list.__add__(self, rhs))
     def __getitem__(self, i):
         if type(i) == slice: return Vector(list.__getitem__(self, i))
@@ -126,7 +190,8 @@ def _vector(*vals): return Vector(vals)
 def _vector_Q(exp): return type(exp) == Vector
 
 # Hash maps
-class Hash_Map(dict): pass
+class Hash_Map(dict):
+    __copy__ = _copy_collection
 def _hash_map(*key_vals):
     hm = Hash_Map()
     for i in range(0,len(key_vals),2): hm[key_vals[i]] = key_vals[i+1]
@@ -137,11 +202,97 @@ def _hash_map_Q(exp): return type(exp) == Hash_Map
 class Atom(object):
     def __init__(self, val):
         self.val = val
+        self.lock = threading.Lock()
+    def reset(self, val):
+        with self.lock:
+            self.val = val
+            return val
+    def compare_and_set(self, old, new):
+        with self.lock:
+            if self.val is not old:
+                return False
+            self.val = new
+            return True
 def _atom(val): return Atom(val)
 def _atom_Q(exp):   return type(exp) == Atom
 
+# counters (deref like atoms, incremented atomically)
+class Counter(object):
+    __slots__ = ('val', 'lock')
+    def __init__(self, val):
+        self.val = val
+        self.lock = threading.Lock()
+    def inc(self, n):
+        with self.lock:
+            self.val += n
+            return self.val
+    def __str__(self): return "(counter %d)" % self.val
+def _counter(val=0): return Counter(val)
+def _counter_Q(exp): return type(exp) == Counter
+
+# futures (deref waits for the result)
+class Future(object):
+    __slots__ = ('fut',)
+    def __init__(self, fut):
+        self.fut = fut
+    def __str__(self):
+        return "(future %s)" % ("done" if self.fut.done() else "pending")
+def _future_Q(exp): return type(exp) == Future
+
+# reduced values (stop reduce and friends early)
+class Reduced(object):
+    def __init__(self, val):
+        self.val = val
+def _reduced(val): return Reduced(val)
+def _reduced_Q(exp): return type(exp) == Reduced
+
+# Python generators, and the iterables given to py-seq, seen as lazy
+# sequences: their items are pulled as they are needed and kept, shared
+# by the sequence and its rests
+class LazySeq(object):
+    __slots__ = ('it', 'items', 'start')
+    def __init__(self, it, items=None, start=0):
+        self.it = it
+        self.items = [] if items is None else items
+        self.start = start
+    def _realize(self, n):
+        """Pull items until n of this sequence are known (all of them
+        when n is None). Return whether there are that many."""
+        items, it = self.items, self.it
+        while n is None or len(items) < self.start + n:
+            try:
+                items.append(next(it))
+            except StopIteration:
+                return n is None
+        return True
+    def __iter__(self):
+        i = self.start
+        while i < len(self.items) or self._realize(i - self.start + 1):
+            yield self.items[i]
+            i += 1
+    def __len__(self):
+        self._realize(None)
+        return len(self.items) - self.start
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            if min(i.start or 0, 0 if i.stop is None else i.stop) < 0:
+                return list(self)[i]
+            return list(islice(self, i.start, i.stop, i.step))
+        if i < 0 or not self._realize(i + 1):
+            raise IndexError("index out of range")
+        return self.items[self.start + i]
+    def empty(self): return not self._realize(1)
+    def rest(self):
+        if self.empty(): return List([])
+        return LazySeq(self.it, self.items, self.start + 1)
+def _lazy_seq_Q(exp): return type(exp) == LazySeq
+
+_range_type = range if sys.version_info[0] >= 3 else xrange
+
 def py_to_mal(obj):
         if type(obj) == list:   return List(obj)
         if type(obj) == tuple:  return List(obj)
         elif type(obj) == dict: return Hash_Map(obj)
+        elif type(obj) == _range_type: return List(obj)
+        elif type(obj) == pytypes.GeneratorType: return LazySeq(obj)
         else:                   return obj
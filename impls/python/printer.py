@@ -1,3 +1,4 @@
+from itertools import chain
 import mal_types as types
 
 def _escape(s):
@@ -5,7 +6,7 @@ def _escape(s):
 
 def _pr_str(obj, print_readably=True):
     _r = print_readably
-    if types._list_Q(obj):
+    if types._list_Q(obj) or types._lazy_seq_Q(obj):
         return "(" + " ".join(map(lambda e: _pr_str(e,_r), obj)) + ")"
     elif types._vector_Q(obj):                                    
         return "[" + " ".join(map(lambda e: _pr_str(e,_r), obj)) + "]"
@@ -32,3 +33,54 @@ def _pr_str(obj, print_readably=True):
     else:
         return obj.__str__()
 
+
+# Pretty printing
+#
+# A collection is printed on one line when it fits, together with the
+# closing brackets that follow it, in the given width. Otherwise its
+# elements go one per line, aligned after the opening bracket, and the
+# values of a map after their keys. With a width of 0 every collection
+# is broken. The output is written to out piece by piece.
+
+_brackets = ((types._list_Q, "(", ")"), (types._vector_Q, "[", "]"),
+             (types._hash_map_Q, "{", "}"))
+
+def _flat_width(obj, limit):
+    """Width of obj printed on one line, or limit+1 if it is wider."""
+    if types._hash_map_Q(obj):
+        n, elts = 2 * len(obj), chain.from_iterable(obj.items())
+    elif types._sequential_Q(obj):
+        n, elts = len(obj), obj
+    else:
+        return len(_pr_str(obj))
+    width = 1 + max(n, 1)
+    for e in elts:
+        if width > limit: break
+        width += _flat_width(e, limit - width)
+    return width
+
+def _pprint(obj, out, width, col=0, trail=0):
+    for pred, opening, closing in _brackets:
+        if pred(obj): break
+    else:
+        out.write(_pr_str(obj))
+        return
+    if len(obj) == 0 or _flat_width(obj, width - col - trail) <= width - col - trail:
+        out.write(_pr_str(obj))
+        return
+    out.write(opening)
+    indent = "\n" + " " * (col + 1)
+    if types._hash_map_Q(obj):
+        last = len(obj) - 1
+        for i, (k, v) in enumerate(obj.items()):
+            if i > 0: out.write(indent)
+            key = _pr_str(k)
+            out.write(key + " ")
+            _pprint(v, out, width, col + len(key) + 2,
+                    trail + 1 if i == last else 0)
+    else:
+        last = len(obj) - 1
+        for i, e in enumerate(obj):
+            if i > 0: out.write(indent)
+            _pprint(e, out, width, col + 1, trail + 1 if i == last else 0)
+    out.write(closing)
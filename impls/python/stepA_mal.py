@@ -1,9 +1,9 @@
 import functools
-import sys, traceback
+import os, sys, traceback
 import mal_readline
 import mal_types as types
-import reader, printer
-from env import Env
+import reader, printer, loader
+from env import Env, bind_plan, pattern_symbols, fn_env
 import core
 
 # read
@@ -45,6 +45,65 @@ def macroexpand(ast, env):
         ast = mac(*ast[1:])
     return ast
 
+# Expand all macro calls in ast, as EVAL would when evaluating it in
+# env. Names bound inside ast (by fn*, let* and catch*) are in bound
+# and shadow macros. Function bodies are expanded when the function is
+# defined, so that calling it never runs macro code again: as in
+# Clojure, redefining a macro changes the functions defined afterwards,
+# not those already defined.
+def expand_all(ast, env, bound=frozenset()):
+    if getattr(ast, '__expanded__', False):
+        return ast
+    elif types._vector_Q(ast):
+        return types._vector(*[expand_all(a, env, bound) for a in ast])
+    elif types._hash_map_Q(ast):
+        return types._hash_map(*[x for k, v in ast.items()
+                                   for x in (k, expand_all(v, env, bound))])
+    elif not types._list_Q(ast) or len(ast) == 0:
+        return ast
+    a0 = ast[0]
+    if (types._symbol_Q(a0) and a0 not in bound and
+            is_macro_call(ast, env)):
+        return expand_all(macroexpand(ast, env), env, bound)
+
+    if a0 in ("quote", "quasiquoteexpand", "macroexpand", "py!*", "py*"):
+        return ast
+    elif "quasiquote" == a0:
+        return expand_all(quasiquote(ast[1]), env, bound)
+    elif "fn*" == a0:
+        return types._list(a0, ast[1], expand_fn_body(ast[2], env, ast[1],
+                                                      bound))
+    elif "let*" == a0:
+        a1 = ast[1]
+        bindings = []
+        for i in range(0, len(a1), 2):
+            bindings.extend((a1[i], expand_all(a1[i+1], env, bound)))
+            bound = bound | pattern_symbols(a1[i])
+        if types._vector_Q(a1): bindings = types._vector(*bindings)
+        else:                   bindings = types._list(*bindings)
+        return types._list(a0, bindings, expand_all(ast[2], env, bound))
+    elif "try*" == a0:
+        res = [a0, expand_all(ast[1], env, bound)]
+        if len(ast) > 2:
+            a2 = ast[2]
+            if types._list_Q(a2) and a2[0] == "catch*":
+                a2 = types._list(a2[0], a2[1], expand_all(
+                    a2[2], env, bound | set([a2[1]])))
+            res.append(a2)
+        return types._list(*res)
+    elif "." == a0:
+        return types._list(*(ast[:2] + [expand_all(a, env, bound)
+                                        for a in ast[2:]]))
+    else:
+        return types._list(*[expand_all(a, env, bound) for a in ast])
+
+def expand_fn_body(body, env, params, bound=frozenset()):
+    body = expand_all(body, env, bound | pattern_symbols(params))
+    if (types._list_Q(body) or types._vector_Q(body) or
+            types._hash_map_Q(body)):
+        body.__expanded__ = True
+    return body
+
 def eval_ast(ast, env):
     if types._symbol_Q(ast):
         return env.get(ast)
@@ -61,6 +120,14 @@ def eval_ast(ast, env):
     else:
         return ast  # primitive value, return unchanged
 
+# Python interop: the source of py* and py!*, and the name called by
+# ., are compiled once per form and the code kept on it
+def py_code(ast, mode):
+    code = ast.__dict__.get('__py__')
+    if code is None:
+        code = ast.__py__ = compile(ast[1], '<mal>', mode)
+    return code
+
 def EVAL(ast, env):
     while True:
         #print("EVAL %s" % printer._pr_str(ast))
@@ -82,7 +149,9 @@ def EVAL(ast, env):
             a1, a2 = ast[1], ast[2]
             let_env = Env(env)
             for i in range(0, len(a1), 2):
-                let_env.set(a1[i], EVAL(a1[i+1], let_env))
+                val = EVAL(a1[i+1], let_env)
+                if types._symbol_Q(a1[i]): let_env.set(a1[i], val)
+                else:                      bind_plan(a1[i])(let_env, val)
             ast = a2
             env = let_env
             # Continue loop (TCO)
@@ -100,14 +169,14 @@ def EVAL(ast, env):
         elif 'macroexpand' == a0:
             return macroexpand(ast[1], env)
         elif "py!*" == a0:
-            exec(compile(ast[1], '', 'single'), globals())
+            exec(py_code(ast, 'single'), globals())
             return None
         elif "py*" == a0:
-            return types.py_to_mal(eval(ast[1]))
+            return types.py_to_mal(eval(py_code(ast, 'eval'), globals()))
         elif "." == a0:
             el = eval_ast(ast[2:], env)
-            f = eval(ast[1])
-            return f(*el)
+            f = eval(py_code(ast, 'eval'), globals())
+            return types.py_to_mal(f(*el))
         elif "try*" == a0:
             if len(ast) < 3:
                 return EVAL(ast[1], env)
@@ -139,7 +208,8 @@ def EVAL(ast, env):
             # Continue loop (TCO)
         elif "fn*" == a0:
             a1, a2 = ast[1], ast[2]
-            return types._function(EVAL, Env, a2, env, a1)
+            return types._function(EVAL, fn_env(a1),
+                                   expand_fn_body(a2, env, a1), env, a1)
         else:
             el = eval_ast(ast, env)
             f = el[0]
@@ -149,6 +219,194 @@ def EVAL(ast, env):
             else:
                 return f(*el[1:])
 
+# eval with an explicit stack
+#
+# EVAL_STACK evaluates like EVAL, but what remains to be done after a
+# subexpression is pushed as a continuation on a list instead of a
+# Python call, so the depth of mal recursion is only limited by
+# memory. Select it with MAL_EVAL=stack.
+
+# continuations
+K_SEQ, K_DEF, K_DEFMACRO, K_LET, K_DO, K_IF, K_TRY = range(7)
+# what to do with an evaluated sequence
+S_CALL, S_VECTOR, S_MAP, S_INTEROP = range(4)
+
+def build_seq(kind, data, vals):
+    if kind == S_VECTOR: return types._vector(*vals)
+    elif kind == S_MAP:  return types._hash_map(*vals)
+    else:                return types.py_to_mal(data(*vals))
+
+def EVAL_STACK(ast, env):
+    stack = []
+    while True:
+        try:
+            # evaluate ast until a value is found, pushing continuations
+            while True:
+                if types._symbol_Q(ast):
+                    val = env.get(ast)
+                    break
+                elif types._vector_Q(ast) or types._hash_map_Q(ast):
+                    if types._vector_Q(ast):
+                        kind, items = S_VECTOR, list(ast)
+                    else:
+                        kind, items = S_MAP, []
+                        for k in ast.keys(): items.extend((k, ast[k]))
+                    if len(items) == 0:
+                        val = build_seq(kind, None, items)
+                        break
+                    stack.append([K_SEQ, items, 0, env, kind, None, []])
+                    ast = items[0]
+                    continue
+                elif not types._list_Q(ast):
+                    val = ast
+                    break
+
+                # apply list
+                ast = macroexpand(ast, env)
+                if not types._list_Q(ast): continue
+                if len(ast) == 0:
+                    val = ast
+                    break
+                a0 = ast[0]
+
+                if "def!" == a0:
+                    stack.append((K_DEF, ast[1], env))
+                    ast = ast[2]
+                elif "let*" == a0:
+                    a1 = ast[1]
+                    env = Env(env)
+                    if len(a1) == 0:
+                        ast = ast[2]
+                    else:
+                        stack.append([K_LET, a1, 0, env, ast[2]])
+                        ast = a1[1]
+                elif "quote" == a0:
+                    val = ast[1]
+                    break
+                elif "quasiquoteexpand" == a0:
+                    val = quasiquote(ast[1])
+                    break
+                elif "quasiquote" == a0:
+                    ast = quasiquote(ast[1])
+                elif 'defmacro!' == a0:
+                    stack.append((K_DEFMACRO, ast[1], env))
+                    ast = ast[2]
+                elif 'macroexpand' == a0:
+                    val = macroexpand(ast[1], env)
+                    break
+                elif "py!*" == a0:
+                    exec(py_code(ast, 'single'), globals())
+                    val = None
+                    break
+                elif "py*" == a0:
+                    val = types.py_to_mal(eval(py_code(ast, 'eval'),
+                                               globals()))
+                    break
+                elif "." == a0:
+                    f = eval(py_code(ast, 'eval'), globals())
+                    if len(ast) == 2:
+                        val = types.py_to_mal(f())
+                        break
+                    stack.append([K_SEQ, ast, 2, env, S_INTEROP, f, []])
+                    ast = ast[2]
+                elif "try*" == a0:
+                    if len(ast) >= 3 and ast[2][0] == "catch*":
+                        stack.append((K_TRY, ast[2], env))
+                    ast = ast[1]
+                elif "do" == a0:
+                    if len(ast) > 2:
+                        stack.append([K_DO, ast, 1, env])
+                        ast = ast[1]
+                    else:
+                        ast = ast[-1]
+                elif "if" == a0:
+                    stack.append((K_IF, ast, env))
+                    ast = ast[1]
+                elif "fn*" == a0:
+                    val = types._function(EVAL_STACK, fn_env(ast[1]),
+                                          expand_fn_body(ast[2], env, ast[1]),
+                                          env, ast[1])
+                    break
+                else:
+                    stack.append([K_SEQ, ast, 0, env, S_CALL, None, []])
+                    ast = ast[0]
+
+            # pass the value to the continuations until one of them
+            # needs another expression evaluated
+            while True:
+                if not stack: return val
+                frame = stack.pop()
+                tag = frame[0]
+                if tag == K_SEQ:
+                    _, items, i, env, kind, data, vals = frame
+                    vals.append(val)
+                    i += 1
+                    if i < len(items):
+                        frame[2] = i
+                        stack.append(frame)
+                        ast = items[i]
+                        break
+                    if kind != S_CALL:
+                        val = build_seq(kind, data, vals)
+                        continue
+                    f = vals[0]
+                    if hasattr(f, '__ast__'):
+                        ast = f.__ast__
+                        env = f.__gen_env__(types._list(*vals[1:]))
+                        break
+                    val = f(*vals[1:])
+                elif tag == K_DEF:
+                    val = frame[2].set(frame[1], val)
+                elif tag == K_DEFMACRO:
+                    func = types._clone(val)
+                    func._ismacro_ = True
+                    val = frame[2].set(frame[1], func)
+                elif tag == K_LET:
+                    _, a1, i, env, body = frame
+                    if types._symbol_Q(a1[i]): env.set(a1[i], val)
+                    else:                      bind_plan(a1[i])(env, val)
+                    i += 2
+                    if i < len(a1):
+                        frame[2] = i
+                        stack.append(frame)
+                        ast = a1[i+1]
+                    else:
+                        ast = body
+                    break
+                elif tag == K_DO:
+                    _, items, i, env = frame
+                    i += 1
+                    if i < len(items) - 1:
+                        frame[2] = i
+                        stack.append(frame)
+                        ast = items[i]
+                    else:
+                        ast = items[-1]
+                    break
+                elif tag == K_IF:
+                    _, ast, env = frame
+                    if val is None or val is False:
+                        if len(ast) > 3: ast = ast[3]
+                        else:            ast = None
+                    else:
+                        ast = ast[2]
+                    break
+                # K_TRY: the protected expression returned normally
+        except Exception as exc:
+            # unwind to the innermost try*
+            while stack and stack[-1][0] != K_TRY: stack.pop()
+            if not stack: raise
+            _, a2, env = stack.pop()
+            if isinstance(exc, types.MalException):
+                err = exc.object
+            else:
+                err = exc.args[0]
+            env = Env(env, [a2[1]], [err])
+            ast = a2[2]
+
+if os.environ.get("MAL_EVAL") == "stack":
+    EVAL = EVAL_STACK
+
 # print
 def PRINT(exp):
     return printer._pr_str(exp)
@@ -161,12 +419,19 @@ def REP(str):
 # core.py: defined using python
 for k, v in core.ns.items(): repl_env.set(types._symbol(k), v)
 repl_env.set(types._symbol('eval'), lambda ast: EVAL(ast, repl_env))
+repl_env.set(types._symbol('expand-all'),
+             lambda ast: expand_all(ast, repl_env))
+repl_env.set(types._symbol('load-file'),
+             lambda f: EVAL(loader.read_file(f), repl_env))
+repl_env.set(types._symbol('load-file-once'),
+             lambda f: EVAL(loader.read_file(f), repl_env)
+                       if loader.mark_loaded(f) else None)
 repl_env.set(types._symbol('*ARGV*'), types._list(*sys.argv[2:]))
 
 # core.mal: defined using the language itself
 REP("(def! *host-language* \"python\")")
 REP("(def! not (fn* (a) (if a false true)))")
-REP("(def! load-file (fn* (f) (eval (read-string (str \"(do \" (slurp f) \"\nnil)\")))))")
+REP("(defmacro! future (fn* (& body) `(future-call (fn* () (do ~@body)))))")
 REP("(defmacro! cond (fn* (& xs) (if (> (count xs) 0) (list 'if (first xs) (if (> (count xs) 1) (nth xs 1) (throw \"odd number of forms to cond\")) (cons 'cond (rest (rest xs)))))))")
 
 if len(sys.argv) >= 2:
@@ -1,11 +1,16 @@
+import atexit
+import html
+import re
 import time
 import os
 import readline
+import subprocess
 import sys
 import xml.etree.ElementTree as ET
 from threading import Thread
 from threading import Lock
 from collections import deque
+from xpath_worker import XPathWorker, transform_command
 
 fname = sys.argv[1]
 args = sys.argv[2:]
@@ -29,125 +34,120 @@ except:
     pass
 
 HALT = False
-THE_PID = None
 init_t = time.time() * 1000
 readline_queue = deque()
-os.system('rm -rf xsl_error.xml')
-os.system('mkfifo xsl_error.xml')
+xpath_worker = XPathWorker()
 
-def setup_request_file():
-    os.system('rm -rf xsl_input-string')
-    os.system('mkfifo xsl_input-string')
+# The stylesheets read the reply to each request from this fifo, by
+# name and up to end of file, so it is created once for the session and
+# opened for each reply.
+REPLY_FIFO = 'xsl_input-string'
 
+def setup_reply_fifo():
+    if os.path.lexists(REPLY_FIFO):
+        os.remove(REPLY_FIFO)
+    os.mkfifo(REPLY_FIFO)
+    atexit.register(os.remove, REPLY_FIFO)
 
-def get_one(fd):
-    s = b""
-    while True:
-        x = os.read(fd, 1)
-        if x == b'\n':
-            break
-        if x == b'':
-            break
-        s += x
-    if s == "":
-        return None
-    return s.decode('utf-8')
+def reply(text):
+    with open(REPLY_FIFO, 'w') as fx:
+        fx.write(text)
+
+
+# Requests are the xsl:message outputs of the stylesheet, one per line
+# on the stderr of saxon, read from a pipe through a buffer.
+REQUEST_RE = re.compile(r'<request\b([^>]*?)/?>')
+ATTRIBUTE_RE = re.compile(r'([\w-]+)="([^"]*)"')
+
+def parse_requests(line):
+    """The attributes of the requests on a line, as dicts."""
+    return [{k: html.unescape(v) for k, v in ATTRIBUTE_RE.findall(m.group(1))}
+            for m in REQUEST_RE.finditer(line)]
+
+
+class RequestChannel:
+    def __init__(self, fd, size=65536):
+        self.fd = fd
+        self.size = size
+        self.buf = bytearray()
+        self.scanned = 0 # no newline in buf[:scanned]
+
+    def read_line(self):
+        """Return the next line, or None once saxon is done."""
+        while True:
+            end = self.buf.find(b'\n', self.scanned)
+            if end >= 0:
+                line = bytes(self.buf[:end])
+                del self.buf[:end + 1]
+                self.scanned = 0
+                return line.decode('utf-8')
+            self.scanned = len(self.buf)
+            data = os.read(self.fd, self.size)
+            if not data:
+                if not self.buf:
+                    return None
+                line = bytes(self.buf)
+                del self.buf[:]
+                self.scanned = 0
+                return line.decode('utf-8')
+            self.buf += data
 
 
 def serve_one_request(res):
     global HALT
-    if len(res) == 0:
-        return
-    try:
-        xtree = ET.fromstring("<data>" + res.strip('\x00') + "</data>")
-        # stdout.write(xtree.attrib['kind'])
-        for req in xtree:
-            if req.attrib['kind'] == 'readline':
-                x = None
-                if len(readline_queue) > 0:
-                    x = readline_queue.popleft()
-                else:
-                    x = input(req.attrib['value'])
-                with open('xsl_input-string', 'w') as fx:
-                    fx.write(x)
-                # stdout.write(' = ' + x)
-            elif req.attrib['kind'] == 'halt':
-                HALT = True
-            elif req.attrib['kind'] == 'display':
-                stdout.write(req.attrib['value'] + '\n')
-            elif req.attrib['kind'] == 'time':
-                x = time.time() * 1000 - init_t
-                # stdout.write(' = ' + str(int(x)))
-                with open('xsl_input-string', 'w') as fx:
-                    fx.write(str(int(x)))
-            # stdout.write('\n')
-            elif req.attrib['kind'] == 'xpath-eval':
-                xpath = req.attrib['value']
-                with open('xsl-eval.xslt', 'w') as f:
-                    f.write(f'<?xml version="1.0" encoding="UTF-8"?><xsl:stylesheet version="3.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform" xmlns:fn="http://www.w3.org/2005/02/xpath-functions"  xmlns:xs="http://www.w3.org/2001/XMLSchema"  xmlns:map="http://www.w3.org/2005/xpath-functions/map" xmlns:env="ENV" xmlns:core="CORE" exclude-result-prefixes="env core xs xsl map fn"><xsl:output omit-xml-declaration="yes"/><xsl:template match="/"><xsl:sequence select="{xpath}" /></xsl:template></xsl:stylesheet>')
-                with open('xsl-null.xml', 'w') as f:
-                    f.write(req.attrib['context'])
-
-                if os.system(f'saxon -xsl:xsl-eval.xslt -s:xsl-null.xml > xsl-eval_output.xml'):
-                    x = ''
-                else:
-                    with open('xsl-eval_output.xml', 'r') as f:
-                        x = f.read()
-                with open('xsl_input-string', 'w') as fx:
-                    fx.write(x)
+    for req in parse_requests(res):
+        kind = req.get('kind')
+        if kind == 'readline':
+            if len(readline_queue) > 0:
+                x = readline_queue.popleft()
             else:
-                stdout.write("UNKNOWN REQUEST " + req.attrib['kind'])
-            # stdout.write('\n')
-    except Exception as e:
-        # if str(e) != 'no element found: line 1, column 0':
-        #     f.seek(0)
-        #     print(e, list(x for x in f.read()))
-        return
-    # with open('xsl_error.xml', 'w') as f:
-    #     f.write('')
-
-def transform(do_print=True):
-    global tree, HALT, THE_PID
+                x = input(req['value'])
+            reply(x)
+        elif kind == 'halt':
+            HALT = True
+        elif kind == 'display':
+            stdout.write(req['value'] + '\n')
+        elif kind == 'time':
+            reply(str(int(time.time() * 1000 - init_t)))
+        elif kind == 'xpath-eval':
+            reply(xpath_worker.evaluate(req['value'], req['context']) or '')
+        else:
+            stdout.write("UNKNOWN REQUEST " + str(kind))
+
+
+def transform():
+    global tree, HALT
 
     tree.write('xslt_input.xml')
-    setup_request_file()
-    pid = os.fork()
-    if pid == 0:
-        os.system(f'saxon -xsl:"{fname}" -s:xslt_input.xml -TP:perf.html > xslt_output.xml 2> xsl_error.xml')
-        HALT = True
-    else:
-        THE_PID = pid
-        fd = os.open('xsl_error.xml', os.O_RDONLY | os.O_CLOEXEC)
-        while True:
-            try:
-                if HALT:
-                    os.kill(THE_PID, 9)
-                    raise KeyboardInterrupt()
-                cmd = get_one(fd)
-                if cmd:
-                    serve_one_request(cmd)
-            except KeyboardInterrupt:
-                exit()
-            except Exception as e:
-                print("Harness error:", e)
-        tree = ET.parse('xslt_output.xml')
-        if do_print:
-            stdout = ''
-            for a in tree.iter('mal'):
-                for a in a.iter('stdout'):
-                    stdout = a
-            print(stdout.text)
-            stdout.clear()
-            del stdout
+    with open('xslt_output.xml', 'w') as out:
+        saxon = subprocess.Popen(transform_command(xpath_worker.backend)
+                                 + ['-xsl:' + fname, '-s:xslt_input.xml',
+                                    '-TP:perf.html'],
+                                 stdout=out, stderr=subprocess.PIPE)
+    channel = RequestChannel(saxon.stderr.fileno())
+    while True:
+        try:
+            if HALT:
+                saxon.kill()
+                raise KeyboardInterrupt()
+            cmd = channel.read_line()
+            if cmd is None:
+                break
+            if cmd:
+                serve_one_request(cmd)
+        except (KeyboardInterrupt, EOFError):
+            exit()
+        except Exception as e:
+            print("Harness error:", e)
+    saxon.wait()
 
 
+setup_reply_fifo()
 if len(args) > 0:
     readline_queue.append(f'(do (load-file "{args0}") (xslt-halt))')
-    transform(do_print=False)
+    transform()
 else:
     if fname == 'stepA_mal.xslt':
         readline_queue.append('(println (str "Mal [" *host-language* "]"))')
-        transform(do_print=False)
-    else:
-        transform()
+    transform()
     readline.write_history_file('.xslt_mal_history')
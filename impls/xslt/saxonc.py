@@ -0,0 +1,26 @@
+import sys
+
+# Stand-in for the `saxon` command (net.sf.saxon.Transform) running
+# SaxonC (the saxonche module), so that the stylesheets and the
+# xpath-eval worker (xpath_worker.py) run on the same engine.
+# Only -xsl: and -s: are used; other options (-TP: ...) are ignored.
+# The result goes to stdout and xsl:message output to stderr.
+
+def main(argv):
+    from saxonche import PySaxonProcessor
+    opts = dict(a[1:].split(':', 1) for a in argv if ':' in a)
+    proc = PySaxonProcessor(license=False)
+    # The stylesheets call readline and the like with constant arguments
+    # and expect a new value each time: keep the optimizer from hoisting
+    # these calls out of the loops
+    proc.set_configuration_property(
+        'http://saxon.sf.net/feature/optimizationLevel', '0')
+    executable = proc.new_xslt30_processor().compile_stylesheet(
+        stylesheet_file=opts['xsl'])
+    sys.stdout.write(executable.transform_to_string(source_file=opts['s'])
+                     or '')
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,159 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+
+# Long-lived worker evaluating the xpath-eval requests of harness.py.
+# Requests ({"xpath": ..., "context": ...}) and replies ({"ok": ...,
+# "result": ...}) are JSON texts, one per line, exchanged over a pipe.
+#
+# Backends:
+#  - saxon: SaxonC (the saxonche module), in process. The stylesheets
+#    wrapping each expression are compiled once and kept in a cache.
+#  - cli: one `saxon` command per request, when saxonche is missing.
+#  - stand-in: answers with the expression itself, to test the harness
+#    without Saxon.
+# The harness runs the mal stylesheets on the same engine, see
+# transform_command.
+
+STYLESHEET = '<?xml version="1.0" encoding="UTF-8"?><xsl:stylesheet version="3.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform" xmlns:fn="http://www.w3.org/2005/02/xpath-functions"  xmlns:xs="http://www.w3.org/2001/XMLSchema"  xmlns:map="http://www.w3.org/2005/xpath-functions/map" xmlns:env="ENV" xmlns:core="CORE" exclude-result-prefixes="env core xs xsl map fn"><xsl:output omit-xml-declaration="yes"/><xsl:template match="/"><xsl:sequence select="{xpath}" /></xsl:template></xsl:stylesheet>'
+
+# The expression is inserted as is, as the harness always did
+def stylesheet(xpath):
+    return STYLESHEET.format(xpath=xpath)
+
+
+class SaxonBackend:
+    def __init__(self, cache_size=256):
+        from saxonche import PySaxonProcessor
+        self.proc = PySaxonProcessor(license=False)
+        self.xslt = self.proc.new_xslt30_processor()
+        self.cache_size = cache_size
+        self.compiled = OrderedDict()
+
+    def compile(self, xpath):
+        executable = self.compiled.pop(xpath, None)
+        if executable is None:
+            executable = self.xslt.compile_stylesheet(
+                stylesheet_text=stylesheet(xpath))
+            if len(self.compiled) >= self.cache_size:
+                self.compiled.popitem(last=False)
+        self.compiled[xpath] = executable
+        return executable
+
+    def evaluate(self, xpath, context):
+        executable = self.compile(xpath)
+        doc = self.proc.parse_xml(xml_text=context)
+        return executable.transform_to_string(xdm_node=doc) or ''
+
+
+class CliBackend:
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix='xsl-eval')
+        self.stylesheets = {}
+
+    def evaluate(self, xpath, context):
+        path = self.stylesheets.get(xpath)
+        if path is None:
+            path = os.path.join(self.dir, '%d.xslt' % len(self.stylesheets))
+            with open(path, 'w') as f:
+                f.write(stylesheet(xpath))
+            self.stylesheets[xpath] = path
+        source = os.path.join(self.dir, 'context.xml')
+        with open(source, 'w') as f:
+            f.write(context)
+        return subprocess.check_output(
+            ['saxon', '-xsl:' + path, '-s:' + source]).decode('utf-8')
+
+
+class StandInBackend:
+    def evaluate(self, xpath, context):
+        return xpath
+
+
+backends = {
+    'saxon': SaxonBackend,
+    'cli': CliBackend,
+    'stand-in': StandInBackend,
+}
+
+def saxonche_available():
+    try:
+        import saxonche
+        return True
+    except ImportError:
+        return False
+
+def default_backend():
+    if saxonche_available():
+        return 'saxon'
+    sys.stderr.write('xpath_worker: saxonche is not installed, falling back '
+                     'to the cli backend (one saxon process per request)\n')
+    return 'cli'
+
+
+# Command running a stylesheet like `saxon`, on the engine of backend
+def transform_command(backend):
+    if backend == 'saxon':
+        here = os.path.dirname(os.path.abspath(__file__))
+        return [sys.executable, os.path.join(here, 'saxonc.py')]
+    return ['saxon']
+
+
+def serve(backend, fin, fout):
+    for line in fin:
+        req = json.loads(line)
+        try:
+            reply = {'ok': True,
+                     'result': backend.evaluate(req['xpath'], req['context'])}
+        except Exception as e:
+            reply = {'ok': False, 'result': str(e)}
+        fout.write(json.dumps(reply) + '\n')
+        fout.flush()
+
+
+class XPathWorker:
+    """Client side of the worker, started on the first request."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or os.environ.get('XSLT_XPATH_BACKEND') \
+            or default_backend()
+        if self.backend not in backends:
+            raise ValueError('unknown xpath backend: %s' % self.backend)
+        if self.backend == 'saxon' and not saxonche_available():
+            raise RuntimeError('the saxon xpath backend needs saxonche')
+        self.proc = None
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), self.backend],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True)
+
+    def evaluate(self, xpath, context):
+        """Return the serialized result, or None if the evaluation
+        failed."""
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+        self.proc.stdin.write(json.dumps({'xpath': xpath,
+                                          'context': context}) + '\n')
+        self.proc.stdin.flush()
+        line = self.proc.stdout.readline()
+        if not line:
+            self.proc = None
+            return None
+        reply = json.loads(line)
+        return reply['result'] if reply['ok'] else None
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+
+
+if __name__ == '__main__':
+    name = sys.argv[1] if len(sys.argv) > 1 else default_backend()
+    serve(backends[name](), sys.stdin, sys.stdout)
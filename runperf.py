@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import os, sys, re
+import argparse, time, json, math
+
+from subprocess import Popen, STDOUT, PIPE
+
+IS_PY_3 = sys.version_info[0] == 3
+
+# Monotonic clock for wall times where available
+clock = getattr(time, 'perf_counter', time.time)
+
+parser = argparse.ArgumentParser(
+        description="Run performance test files against a Mal implementation "
+                    "several times and report statistics")
+parser.add_argument('--rundir',
+        help="change to the directory before running the benchmarks")
+parser.add_argument('--runs', default=5, type=int,
+        help="number of times each performance file is run")
+parser.add_argument('--label', type=str,
+        help="name for this run in the JSON output and comparisons "
+             "(e.g. the implementation or commit)")
+parser.add_argument('--json', type=str,
+        help="write the results as JSON to the named file")
+parser.add_argument('--compare', nargs='+', metavar='JSON_FILE',
+        help="compare earlier JSON results instead of running anything; "
+             "ratios are relative to the first file")
+parser.add_argument('perf_files', nargs='*',
+        help="performance test files (printing 'Elapsed time', "
+             "'iters over' and 'ns per iteration' lines as lib/perf.mal "
+             "and tests/perf*.mal do)")
+parser.add_argument('mal_cmd', nargs="*",
+        help="Mal implementation command line. Use '--' to "
+             "specify a Mal command line with dashed options.")
+
+# Lines printed by the `time` macro and by users of `run-fn-for` and
+# `benchmark`
+ELAPSED_RE = re.compile(r"Elapsed time: ([0-9.]+) msecs(?: \(([0-9]+) nsecs\))?")
+ITERS_RE = re.compile(r"iters over ([0-9.]+) seconds: ([0-9]+)")
+NS_PER_ITER_RE = re.compile(r"ns per iteration: ([0-9.]+) \+/- ([0-9.]+)")
+
+def stats(samples):
+    """Summary statistics of a list of numbers."""
+    ordered = sorted(samples)
+    n = len(ordered)
+    mean = sum(ordered) / float(n)
+    if n % 2: median = ordered[n // 2]
+    else:     median = (ordered[n // 2 - 1] + ordered[n // 2]) / 2.0
+    if n > 1:
+        stddev = math.sqrt(sum((x - mean) ** 2 for x in ordered) / (n - 1))
+    else:
+        stddev = 0.0
+    return {'samples': samples, 'min': ordered[0], 'max': ordered[-1],
+            'median': median, 'mean': mean, 'stddev': stddev}
+
+def run_once(mal_cmd, perf_file):
+    """Run a performance file once. Return the wall time in
+    milliseconds and the output."""
+    start = clock()
+    p = Popen(mal_cmd + [perf_file], stdout=PIPE, stderr=STDOUT)
+    out = p.communicate()[0]
+    wall_ms = (clock() - start) * 1000
+    out = out.decode("utf-8") if IS_PY_3 else out
+    if p.returncode != 0:
+        raise Exception("%s exited with %d:\n%s" % (perf_file, p.returncode, out))
+    return wall_ms, out
+
+def run_perf_file(mal_cmd, perf_file, runs):
+    """Collect samples of every metric reported by a performance file
+    over several runs. Return a dictionary of metric name to stats."""
+    samples = {'wall_ms': []}
+    for i in range(runs):
+        wall_ms, out = run_once(mal_cmd, perf_file)
+        print("  run %d/%d: %.0f ms" % (i + 1, runs, wall_ms))
+        sys.stdout.flush()
+        samples['wall_ms'].append(wall_ms)
+        for j, m in enumerate(ELAPSED_RE.finditer(out)):
+            if m.group(2): elapsed_ms = int(m.group(2)) / 1000000.0
+            else:          elapsed_ms = float(m.group(1))
+            samples.setdefault('elapsed_ms.%d' % j, []).append(elapsed_ms)
+        for j, m in enumerate(ITERS_RE.finditer(out)):
+            secs, iters = float(m.group(1)), int(m.group(2))
+            samples.setdefault('iters.%d' % j, []).append(iters)
+            samples.setdefault('iters_per_sec.%d' % j, []).append(iters / secs)
+        for j, m in enumerate(NS_PER_ITER_RE.finditer(out)):
+            samples.setdefault('ns_per_iter.%d' % j, []).append(float(m.group(1)))
+    return dict((k, stats(v)) for k, v in samples.items())
+
+def print_results(results):
+    print("\n%-12s %-18s %12s %12s %12s" % (
+        "benchmark", "metric", "min", "median", "stddev"))
+    for bench in sorted(results['benchmarks']):
+        metrics = results['benchmarks'][bench]
+        for metric in sorted(metrics):
+            s = metrics[metric]
+            print("%-12s %-18s %12.2f %12.2f %12.2f" % (
+                bench, metric, s['min'], s['median'], s['stddev']))
+
+def compare(files):
+    """Print the medians of several JSON results side by side."""
+    runs = []
+    for path in files:
+        with open(path) as f:
+            res = json.load(f)
+        runs.append((res.get('label') or path, res['benchmarks']))
+    labels = [label for label, _ in runs]
+    print("%-12s %-18s " % ("benchmark", "metric") +
+          " ".join("%20s" % l[:20] for l in labels))
+    base = runs[0][1]
+    for bench in sorted(base):
+        for metric in sorted(base[bench]):
+            base_median = base[bench][metric]['median']
+            cols = []
+            for _, benchmarks in runs:
+                s = benchmarks.get(bench, {}).get(metric)
+                if s is None:
+                    cols.append("%20s" % "-")
+                elif base_median:
+                    cols.append("%11.2f (%5.2fx)" % (
+                        s['median'], s['median'] / base_median))
+                else:
+                    cols.append("%20.2f" % s['median'])
+            print("%-12s %-18s " % (bench, metric) + " ".join(cols))
+
+# Workaround argparse issue with two '--' on command line
+if sys.argv.count('--') > 0:
+    args = parser.parse_args(sys.argv[1:sys.argv.index('--')])
+    args.mal_cmd = sys.argv[sys.argv.index('--')+1:]
+else:
+    args = parser.parse_args(sys.argv[1:])
+
+if args.compare:
+    compare(args.compare)
+    sys.exit(0)
+
+if not args.perf_files or not args.mal_cmd:
+    parser.error("performance files and a Mal command line (after '--') "
+                 "are required")
+
+if args.rundir: os.chdir(args.rundir)
+
+results = {'label': args.label, 'mal_cmd': args.mal_cmd, 'runs': args.runs,
+           'time': time.time(), 'benchmarks': {}}
+for perf_file in args.perf_files:
+    print("Running %s %d times" % (perf_file, args.runs))
+    sys.stdout.flush()
+    try:
+        metrics = run_perf_file(args.mal_cmd, perf_file, args.runs)
+    except Exception:
+        _, exc, _ = sys.exc_info()
+        print("\nException: %s" % exc)
+        sys.exit(1)
+    results['benchmarks'][os.path.basename(perf_file)] = metrics
+
+print_results(results)
+
+if args.json:
+    with open(args.json, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
@@ -2,8 +2,8 @@
 
 from __future__ import print_function
 import os, sys, re
-import argparse, time
-import signal, atexit
+import argparse, time, json
+import signal, atexit, threading
 
 from subprocess import Popen, STDOUT, PIPE
 from select import select
@@ -13,6 +13,9 @@ import pty, array, fcntl, termios
 
 IS_PY_3 = sys.version_info[0] == 3
 
+# Monotonic clock for test timings where available
+clock = getattr(time, 'perf_counter', time.time)
+
 debug_file = None
 log_file = None
 
@@ -67,8 +70,27 @@ parser.add_argument('test_file', type=str,
 parser.add_argument('mal_cmd', nargs="*",
         help="Mal implementation command line. Use '--' to "
              "specify a Mal command line with dashed options.")
+parser.add_argument('--test-file', dest='test_files', action='append',
+        default=[], metavar='TEST_FILE',
+        help="Another test file to run after test_file (may be repeated)")
 parser.add_argument('--crlf', dest='crlf', action='store_true',
         help="Write \\r\\n instead of \\n to the input")
+parser.add_argument('--batch', action='store_true',
+        help="Use the line-delimited JSON batch protocol if the "
+             "implementation supports it (falls back to the REPL)")
+parser.add_argument('--warm', action='store_true',
+        help="Implies --batch. Reuse one interpreter for all test files, "
+             "resetting it in between if the implementation supports it")
+
+# Timing capture and performance regression checks
+parser.add_argument('--results-file', type=str,
+        help="Append a JSON line with per-test timings to the named file")
+parser.add_argument('--baseline', type=str,
+        help="Compare timings against a results file from an earlier run")
+parser.add_argument('--regress-threshold', default=1.5, type=float,
+        help="Flag tests slower than this factor times the baseline")
+parser.add_argument('--regress-min-ms', default=5.0, type=float,
+        help="Ignore slowdowns smaller than this many milliseconds")
 
 class Runner():
     def __init__(self, args, no_pty=False, line_break="\n"):
@@ -153,6 +175,126 @@ class Runner():
                 pass
             self.p = None
 
+class BatchRunner():
+    """Talk to an implementation over the line-delimited JSON batch
+    protocol. The implementation is started with MAL_BATCH=1 and opts
+    in by answering with a {"protocol": "mal-batch"} line instead of a
+    prompt. Each request {"id": N, "form": "..."} is then answered by
+    {"id": N, "out": "..."} with everything printed for that form.
+    If the handshake includes "reset": true, the request
+    {"id": N, "reset": true} restores the interpreter to its state at
+    the handshake and is answered like a form."""
+    def __init__(self, args):
+        atexit.register(self.cleanup)
+
+        env = os.environ.copy()
+        env['TERM'] = 'dumb'
+        env['INPUTRC'] = '/dev/null'
+        env['PERL_RL'] = 'false'
+        env['MAL_BATCH'] = '1'
+        self.p = Popen(args, bufsize=0,
+                       stdin=PIPE, stdout=PIPE, stderr=STDOUT,
+                       preexec_fn=os.setsid,
+                       env=env)
+        self.stdout = self.p.stdout.fileno()
+        self.buf = ""
+        self.next_id = 0
+        self.writer = None
+        self.can_reset = False
+
+    def _read_line(self, end_time, prompt=None):
+        while "\n" not in self.buf:
+            if time.time() >= end_time:
+                return None
+            if prompt and prompt.search(self.buf):
+                return None
+            [outs,_,_] = select([self.stdout], [], [], 1)
+            if self.stdout in outs:
+                new_data = os.read(self.stdout, 65536)
+                if not new_data:
+                    raise Exception("implementation exited")
+                new_data = new_data.decode("utf-8") if IS_PY_3 else new_data
+                debug(new_data)
+                self.buf += new_data
+        line, self.buf = self.buf.split("\n", 1)
+        return line
+
+    def handshake(self, timeout):
+        """Return the startup output, or None if the implementation
+        does not speak the batch protocol."""
+        end_time = time.time() + timeout
+        header = ""
+        prompt = re.compile('[^\s()<>]+> $')
+        while True:
+            line = self._read_line(end_time, prompt)
+            if line is None:
+                return None
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                header += line + "\n"
+                continue
+            if isinstance(msg, dict) and msg.get('protocol') == 'mal-batch':
+                self.can_reset = bool(msg.get('reset'))
+                return header + msg.get('out', "")
+            return None
+
+    def send(self, forms):
+        """Queue forms for evaluation; return their request ids."""
+        ids = list(range(self.next_id, self.next_id + len(forms)))
+        self.next_id += len(forms)
+        self._write("".join(json.dumps({'id': i, 'form': f}) + "\n"
+                            for i, f in zip(ids, forms)))
+        return ids
+
+    def reset(self, timeout):
+        """Restore the startup state; return False on timeout. Nothing
+        else may be sent until the reset is answered, since the old
+        interpreter state may have buffered it."""
+        req_id = self.next_id
+        self.next_id += 1
+        self._write(json.dumps({'id': req_id, 'reset': True}) + "\n")
+        return self.result(req_id, "", timeout) is not None
+
+    def _write(self, data):
+        data = data.encode("utf-8") if IS_PY_3 else data
+        # Write from a thread so a full stdout pipe cannot deadlock us
+        def write():
+            try:
+                self.p.stdin.write(data)
+                self.p.stdin.flush()
+            except (IOError, OSError):
+                pass
+        if self.writer: self.writer.join()
+        self.writer = threading.Thread(target=write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def result(self, req_id, form, timeout):
+        """Return the output for req_id shaped like a REPL exchange
+        (echoed form, then output), or None on timeout."""
+        end_time = time.time() + timeout
+        while True:
+            line = self._read_line(end_time)
+            if line is None:
+                return None
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(msg, dict) and msg.get('id') == req_id:
+                out = msg.get('out', "")
+                if out[-1:] == "\n": out = out[0:-1]
+                return form + "\n" + out
+
+    def cleanup(self):
+        if self.p:
+            try:
+                os.killpg(self.p.pid, signal.SIGTERM)
+            except OSError:
+                pass
+            self.p = None
+
 class TestReader:
     def __init__(self, test_file):
         self.line_num = 0
@@ -217,18 +359,46 @@ class TestReader:
             self.out = self.out[0:-1]
         return self.form
 
-args = parser.parse_args(sys.argv[1:])
-# Workaround argparse issue with two '--' on command line
-if sys.argv.count('--') > 0:
-    args.mal_cmd = sys.argv[sys.argv.index('--')+1:]
+class TestTimeout(Exception):
+    pass
 
-if args.rundir: os.chdir(args.rundir)
 
-if args.log_file:   log_file   = open(args.log_file, "a")
-if args.debug_file: debug_file = open(args.debug_file, "a")
+def start_runner():
+    """Start the implementation and wait until it is ready for tests.
+    Return the runner and the startup time in milliseconds."""
+    start_time = clock()
+    r = None
+    if args.batch:
+        r = BatchRunner(args.mal_cmd)
+        try:
+            header = r.handshake(args.start_timeout)
+        except:
+            header = None
+        if header is None:
+            log("No batch protocol support, falling back to the REPL")
+            r.cleanup()
+            r = None
+            start_time = clock()
+        elif header:
+            log("Started with:\n%s" % header)
+    if r is None:
+        r = Runner(args.mal_cmd, no_pty=args.no_pty, line_break="\r\n" if args.crlf else "\n")
+
+        # Wait for the initial prompt
+        try:
+            assert_prompt(r, ['[^\s()<>]+> '], args.start_timeout)
+        except:
+            _, exc, _ = sys.exc_info()
+            log("\nException: %s" % repr(exc))
+            log("Output before exception:\n%s" % r.buf)
+            sys.exit(1)
+    startup_ms = (clock() - start_time) * 1000
 
-r = Runner(args.mal_cmd, no_pty=args.no_pty, line_break="\r\n" if args.crlf else "\n")
-t = TestReader(args.test_file)
+    # Send the pre-eval code if any
+    if args.pre_eval:
+        pre_eval(r)
+
+    return r, startup_ms
 
 
 def assert_prompt(runner, prompts, timeout):
@@ -239,111 +409,242 @@ def assert_prompt(runner, prompts, timeout):
             log("Started with:\n%s" % header)
     else:
         log("Did not receive one of following prompt(s): %s" % repr(prompts))
-        log("    Got      : %s" % repr(r.buf))
+        log("    Got      : %s" % repr(runner.buf))
         sys.exit(1)
 
 
-# Wait for the initial prompt
-try:
-    assert_prompt(r, ['[^\s()<>]+> '], args.start_timeout)
-except:
-    _, exc, _ = sys.exc_info()
-    log("\nException: %s" % repr(exc))
-    log("Output before exception:\n%s" % r.buf)
-    sys.exit(1)
-
-# Send the pre-eval code if any
-if args.pre_eval:
+def pre_eval(r):
     sys.stdout.write("RUNNING pre-eval: %s" % args.pre_eval)
-    r.writeline(args.pre_eval)
-    assert_prompt(r, ['[^\s()<>]+> '], args.test_timeout)
-
-test_cnt = 0
-pass_cnt = 0
-fail_cnt = 0
-soft_fail_cnt = 0
-failures = []
+    if isinstance(r, BatchRunner):
+        [pre_id] = r.send([args.pre_eval])
+        if r.result(pre_id, args.pre_eval, args.test_timeout) is None:
+            log("Did not receive a result for pre-eval")
+            sys.exit(1)
+    else:
+        r.writeline(args.pre_eval)
+        assert_prompt(r, ['[^\s()<>]+> '], args.test_timeout)
 
-class TestTimeout(Exception):
-    pass
 
-while t.next():
-    if args.deferrable == False and t.deferrable:
-        log(t.deferrable)
-        break
-
-    if args.optional == False and t.optional:
-        log(t.optional)
-        break
-
-    if t.msg != None:
-        log(t.msg)
-        continue
-
-    if t.form == None: continue
-
-    log("TEST: %s -> [%s,%s]" % (repr(t.form), repr(t.out), t.ret), end='')
-
-    # The repeated form is to get around an occasional OS X issue
-    # where the form is repeated.
-    # https://github.com/kanaka/mal/issues/30
-    expects = [".*%s%s%s" % (sep, t.out, re.escape(t.ret)),
-               ".*%s.*%s%s%s" % (sep, sep, t.out, re.escape(t.ret))]
-
-    r.writeline(t.form)
-    try:
-        test_cnt += 1
-        res = r.read_to_prompt(['\r\n[^\s()<>]+> ', '\n[^\s()<>]+> '],
-                                timeout=args.test_timeout)
-        #print "%s,%s,%s" % (idx, repr(p.before), repr(p.after))
-        if (res == None):
-            log(" -> TIMEOUT (line %d)" % t.line_num)
-            raise TestTimeout("TIMEOUT (line %d)" % t.line_num)
-        elif (t.ret == "" and t.out == ""):
-            log(" -> SUCCESS (result ignored)")
-            pass_cnt += 1
-        elif (re.search(expects[0], res, re.S) or
-                re.search(expects[1], res, re.S)):
-            log(" -> SUCCESS")
-            pass_cnt += 1
-        else:
-            if t.soft and not args.hard:
-                log(" -> SOFT FAIL (line %d):" % t.line_num)
-                soft_fail_cnt += 1
-                fail_type = "SOFT "
+def reset_runner(r):
+    """Return the warm runner to its startup state. Return the reset
+    time in milliseconds."""
+    start_time = clock()
+    if not r.reset(args.start_timeout):
+        log("Did not receive a result for reset")
+        sys.exit(1)
+    if args.pre_eval:
+        pre_eval(r)
+    return (clock() - start_time) * 1000
+
+
+def load_baseline(path, test_file):
+    # The last record for this test file wins
+    baseline = None
+    with open(path) as f:
+        for line in f:
+            if not line.strip(): continue
+            rec = json.loads(line)
+            if rec.get('test_file') == test_file:
+                baseline = rec
+    return baseline
+
+def is_regression(ms, base_ms):
+    return (ms > base_ms * args.regress_threshold and
+            ms - base_ms >= args.regress_min_ms)
+
+
+def run_test_file(r, test_file, startup_ms):
+    """Run every test of test_file against the runner. Return the
+    number of hard failures."""
+    batch = isinstance(r, BatchRunner)
+    t = TestReader(test_file)
+
+    test_cnt = 0
+    pass_cnt = 0
+    fail_cnt = 0
+    soft_fail_cnt = 0
+    failures = []
+    timings = []
+
+    # Read the whole test file up front so that the batch protocol can
+    # send every form at once. Entries are either a message to log or a
+    # test tuple (form, out, ret, line_num, soft).
+    entries = []
+    while t.next():
+        if args.deferrable == False and t.deferrable:
+            entries.append(t.deferrable)
+            break
+
+        if args.optional == False and t.optional:
+            entries.append(t.optional)
+            break
+
+        if t.msg != None:
+            entries.append(t.msg)
+            continue
+
+        if t.form == None: continue
+
+        entries.append((t.form, t.out, t.ret, t.line_num, t.soft))
+
+    if batch:
+        req_ids = iter(r.send([e[0] for e in entries if isinstance(e, tuple)]))
+    # In batch mode forms are evaluated back to back, so each test is
+    # timed from the arrival of the previous result.
+    last_time = clock()
+
+    for entry in entries:
+        if not isinstance(entry, tuple):
+            log(entry)
+            continue
+        form, out, ret, line_num, soft = entry
+
+        log("TEST: %s -> [%s,%s]" % (repr(form), repr(out), ret), end='')
+
+        # The repeated form is to get around an occasional OS X issue
+        # where the form is repeated.
+        # https://github.com/kanaka/mal/issues/30
+        expects = [".*%s%s%s" % (sep, out, re.escape(ret)),
+                   ".*%s.*%s%s%s" % (sep, sep, out, re.escape(ret))]
+
+        if not batch:
+            last_time = clock()
+            r.writeline(form)
+        try:
+            test_cnt += 1
+            if batch:
+                res = r.result(next(req_ids), form, timeout=args.test_timeout)
             else:
-                log(" -> FAIL (line %d):" % t.line_num)
-                fail_cnt += 1
-                fail_type = ""
-            log("    Expected : %s" % repr(expects[0]))
-            log("    Got      : %s" % repr(res))
-            failed_test = """%sFAILED TEST (line %d): %s -> [%s,%s]:
+                res = r.read_to_prompt(['\r\n[^\s()<>]+> ', '\n[^\s()<>]+> '],
+                                        timeout=args.test_timeout)
+            now = clock()
+            timing = {'line': line_num, 'form': form,
+                      'ms': round((now - last_time) * 1000, 3)}
+            timings.append(timing)
+            last_time = now
+            #print "%s,%s,%s" % (idx, repr(p.before), repr(p.after))
+            if (res == None):
+                log(" -> TIMEOUT (line %d)" % line_num)
+                raise TestTimeout("TIMEOUT (line %d)" % line_num)
+            elif (ret == "" and out == ""):
+                log(" -> SUCCESS (result ignored)")
+                pass_cnt += 1
+                timing['result'] = 'pass'
+            elif (re.search(expects[0], res, re.S) or
+                    re.search(expects[1], res, re.S)):
+                log(" -> SUCCESS")
+                pass_cnt += 1
+                timing['result'] = 'pass'
+            else:
+                if soft and not args.hard:
+                    log(" -> SOFT FAIL (line %d):" % line_num)
+                    soft_fail_cnt += 1
+                    fail_type = "SOFT "
+                    timing['result'] = 'soft-fail'
+                else:
+                    log(" -> FAIL (line %d):" % line_num)
+                    fail_cnt += 1
+                    fail_type = ""
+                    timing['result'] = 'fail'
+                log("    Expected : %s" % repr(expects[0]))
+                log("    Got      : %s" % repr(res))
+                failed_test = """%sFAILED TEST (line %d): %s -> [%s,%s]:
     Expected : %s
-    Got      : %s""" % (fail_type, t.line_num, t.form, repr(t.out),
-                        t.ret, repr(expects[0]), repr(res))
-            failures.append(failed_test)
-    except:
-        _, exc, _ = sys.exc_info()
-        log("\nException: %s" % repr(exc))
-        log("Output before exception:\n%s" % r.buf)
-        sys.exit(1)
-
-if len(failures) > 0:
-    log("\nFAILURES:")
-    for f in failures:
-        log(f)
-
-results = """
+    Got      : %s""" % (fail_type, line_num, form, repr(out),
+                            ret, repr(expects[0]), repr(res))
+                failures.append(failed_test)
+        except:
+            _, exc, _ = sys.exc_info()
+            log("\nException: %s" % repr(exc))
+            log("Output before exception:\n%s" % r.buf)
+            sys.exit(1)
+
+    if len(failures) > 0:
+        log("\nFAILURES:")
+        for f in failures:
+            log(f)
+
+    regressions = []
+    if args.baseline:
+        baseline = load_baseline(args.baseline, test_file)
+        if baseline is None:
+            log("\nNo baseline timings for %s in %s" % (test_file,
+                                                       args.baseline))
+        else:
+            base_ms = baseline.get('startup_ms')
+            if base_ms is not None and is_regression(startup_ms, base_ms):
+                regressions.append("startup: %.1f ms (baseline %.1f ms)" % (
+                    startup_ms, base_ms))
+            base_tests = dict(((b['line'], b['form']), b['ms'])
+                              for b in baseline.get('tests', []))
+            for timing in timings:
+                base_ms = base_tests.get((timing['line'], timing['form']))
+                if base_ms is not None and is_regression(timing['ms'], base_ms):
+                    timing['regressed'] = True
+                    regressions.append("line %d: %s: %.1f ms (baseline %.1f ms)" % (
+                        timing['line'], timing['form'], timing['ms'], base_ms))
+        if regressions:
+            log("\nSLOW TESTS (more than %sx baseline):" % args.regress_threshold)
+            for reg in regressions:
+                log("    " + reg)
+
+    results = """
 TEST RESULTS (for %s):
   %3d: soft failing tests
   %3d: failing tests
   %3d: passing tests
   %3d: total tests
-""" % (args.test_file, soft_fail_cnt, fail_cnt,
-        pass_cnt, test_cnt)
-log(results)
+""" % (test_file, soft_fail_cnt, fail_cnt,
+            pass_cnt, test_cnt)
+    if args.baseline:
+        results += "  %3d: slow tests\n" % len(regressions)
+    log(results)
+
+    if args.results_file:
+        with open(args.results_file, "a") as f:
+            f.write(json.dumps({
+                'test_file': test_file,
+                'mal_cmd': args.mal_cmd,
+                'protocol': 'batch' if batch else 'pipe' if args.no_pty else 'pty',
+                'warm': args.warm,
+                'time': time.time(),
+                'startup_ms': round(startup_ms, 3),
+                'total_ms': round(sum(t['ms'] for t in timings), 3),
+                'soft_failing': soft_fail_cnt,
+                'failing': fail_cnt,
+                'passing': pass_cnt,
+                'tests': timings}) + "\n")
+
+    debug("\n") # add some separate to debug log
+
+    return fail_cnt
+
+
+# Workaround argparse issue with two '--' on command line (and with
+# options such as --test-file between test_file and mal_cmd)
+if sys.argv.count('--') > 0:
+    args = parser.parse_args(sys.argv[1:sys.argv.index('--')])
+    args.mal_cmd = sys.argv[sys.argv.index('--')+1:]
+else:
+    args = parser.parse_args(sys.argv[1:])
+# A warm interpreter is reset through the batch protocol
+if args.warm:
+    args.batch = True
 
-debug("\n") # add some separate to debug log
+if args.rundir: os.chdir(args.rundir)
+
+if args.log_file:   log_file   = open(args.log_file, "a")
+if args.debug_file: debug_file = open(args.debug_file, "a")
+
+fail_cnt = 0
+r = None
+for test_file in [args.test_file] + args.test_files:
+    if r and args.warm and getattr(r, 'can_reset', False):
+        startup_ms = reset_runner(r)
+    else:
+        if r: r.cleanup()
+        r, startup_ms = start_runner()
+    fail_cnt += run_test_file(r, test_file, startup_ms)
 
 if fail_cnt > 0:
     sys.exit(1)